@@ -0,0 +1,199 @@
+"""this module handles on-disk caches of intermediate results"""
+
+# built in imports
+import os
+import csv
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+
+# 3rd party imports
+import numpy as np
+from PIL import Image
+
+
+def atomic_write(path, write, mode='wb'):
+    """write(f) to a uniquely named temporary file next to path, then replace path with it.
+       Concurrent writers (eg RUN jobs sharing a cache dir) never see or clobber each other's partial files"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path)+'.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **(dict(newline='') if 'b' not in mode else {})) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def pyifcb_version():
+    try: return metadata.version('pyifcb')
+    except metadata.PackageNotFoundError: return 'unknown'
+
+
+def file_fingerprint(path, chunk_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ScoreCache:
+    """
+    Raw RUN scores keyed by (model_id, bin_id), so that result files can be regenerated without re-inference.
+    Entries are {cache_dir}/{model_id}/{bin_id}.npz files containing roi_numbers and output_scores.
+    The cache of a model_id is cleared whenever its checkpoint file changes.
+    Example usage:    cache = ScoreCache('run-cache', model_id, 'path/to/model.ptl', max_size=50*2**30)
+                      if bin_id in cache: roi_numbers, output_scores = cache.get(bin_id)
+    """
+    MANIFEST = 'checkpoint.json'
+
+    def __init__(self, cache_dir, model_id, checkpoint, max_size=None):
+        self.model_id = model_id
+        self.model_dir = os.path.join(cache_dir, model_id)
+        self.max_size = max_size  # bytes
+        os.makedirs(self.model_dir, exist_ok=True)
+        self.validate(checkpoint)
+        self.size = sum(os.path.getsize(path) for path in self._entries())
+
+    def validate(self, checkpoint):
+        """clears the cache if it was created by a different checkpoint file"""
+        fingerprint = dict(model_id=self.model_id, sha1=file_fingerprint(checkpoint))
+        manifest = os.path.join(self.model_dir, self.MANIFEST)
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                if json.load(f) == fingerprint: return
+            print('Checkpoint for "{}" has changed, clearing score-cache'.format(self.model_id))
+            self.clear()
+        with open(manifest, 'w') as f:
+            json.dump(fingerprint, f)
+
+    def clear(self):
+        for path in self._entries():
+            os.remove(path)
+        self.size = 0
+
+    def _entries(self):
+        return [entry.path for entry in os.scandir(self.model_dir) if entry.name.endswith('.npz')]
+
+    def _path(self, bin_id):
+        return os.path.join(self.model_dir, '{}.npz'.format(bin_id))
+
+    def __contains__(self, bin_id):
+        return os.path.isfile(self._path(bin_id))
+
+    def get(self, bin_id):
+        path = self._path(bin_id)
+        with np.load(path) as npz:
+            roi_numbers, output_scores = npz['roi_numbers'], npz['output_scores']
+        os.utime(path)  # recently used entries are evicted last
+        return roi_numbers, output_scores
+
+    def put(self, bin_id, roi_numbers, output_scores):
+        path = self._path(bin_id)
+        if os.path.isfile(path): self.size -= os.path.getsize(path)
+        atomic_write(path, lambda f: np.savez_compressed(f, roi_numbers=np.asarray(roi_numbers, dtype='u4'),
+                                                            output_scores=np.asarray(output_scores, dtype='f4')))
+        self.size += os.path.getsize(path)
+        if self.max_size and self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """removes least-recently-used entries until the cache is at 90% of max_size"""
+        entries = sorted(os.scandir(self.model_dir), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= 0.9*self.max_size: break
+            if not entry.name.endswith('.npz'): continue
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+class StitchCache:
+    """
+    Stitched and infilled ROIs of old-style (SCHEMA_VERSION_1) bins, so that stitching is done once per bin rather than once per run.
+    Entries are {cache_dir}/stitch-{VERSION}/{bin_id}.npz files containing roi_numbers, shapes and the flattened uint8 pixels of all images.
+    VERSION includes the pyifcb version, so entries made by a different stitching implementation are never read.
+    Example usage:    cache = StitchCache('stitch-cache')
+                      if bin_id not in cache: cache.put(bin_id, dict(InfilledImages(bin)))
+                      images = cache.get(bin_id)
+    """
+    VERSION = 'v1-pyifcb{}'.format(pyifcb_version())
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.join(cache_dir, 'stitch-{}'.format(self.VERSION))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, bin_id):
+        return os.path.join(self.cache_dir, '{}.npz'.format(bin_id))
+
+    def __contains__(self, bin_id):
+        return os.path.isfile(self._path(bin_id))
+
+    def get(self, bin_id):
+        """returns {roi_number: image}"""
+        with np.load(self._path(bin_id)) as npz:
+            roi_numbers, shapes, pixels = npz['roi_numbers'], npz['shapes'], npz['pixels']
+        offsets = np.concatenate([[0], np.cumsum(shapes.prod(axis=1))])
+        return {int(roi): pixels[start:end].reshape(shape)
+                for roi, shape, start, end in zip(roi_numbers, shapes, offsets[:-1], offsets[1:])}
+
+    def put(self, bin_id, images):
+        """images is {roi_number: image}"""
+        roi_numbers = sorted(images)
+        shapes = np.array([images[roi].shape for roi in roi_numbers], dtype='u4').reshape(-1, 2)
+        pixels = np.concatenate([np.asarray(images[roi], dtype='u1').ravel() for roi in roi_numbers]) if images else np.zeros(0, dtype='u1')
+        path = self._path(bin_id)
+        atomic_write(path, lambda f: np.savez(f, roi_numbers=np.asarray(roi_numbers, dtype='u4'), shapes=shapes, pixels=pixels))
+
+
+def image_fingerprint(path):
+    """sha1 of an image's decoded pixels, such that re-encoded copies of an image match"""
+    with Image.open(path) as img:
+        sha1 = hashlib.sha1('{} {}x{} '.format(img.mode, *img.size).encode())
+        sha1.update(img.tobytes())
+    return sha1.hexdigest()
+
+
+class ImageHashCache:
+    """
+    Content hashes of the images of a dataset directory, cached in {dataset_dir}/.image_hashes.csv
+    An image is only rehashed if its size or mtime has changed.
+    Example usage:    cache = ImageHashCache('path/to/dataset')
+                      hashes = cache.hashes(image_paths)  # {image_path: sha1}
+                      cache.save()
+    """
+    FILENAME = '.image_hashes.csv'
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        self.path = os.path.join(dataset_dir, self.FILENAME)
+        self.entries = {}  # relative path: (size, mtime, sha1)
+        self.changed = False
+        if os.path.isfile(self.path):
+            with open(self.path, newline='') as f:
+                for relpath, size, mtime, sha1 in csv.reader(f):
+                    self.entries[relpath] = (size, mtime, sha1)
+
+    def hashes(self, image_paths, threads=8):
+        stats = {path: os.stat(path) for path in image_paths}
+        keys = {path: (str(stat.st_size), repr(stat.st_mtime)) for path,stat in stats.items()}
+        relpaths = {path: os.path.relpath(path, self.dataset_dir) for path in image_paths}
+        missing = [path for path in image_paths if self.entries.get(relpaths[path], (None,None))[:2] != keys[path]]
+        if missing:
+            print('Hashing {} images of {}...'.format(len(missing), self.dataset_dir), flush=True)
+            with ThreadPoolExecutor(threads) as pool:
+                for path,sha1 in zip(missing, pool.map(image_fingerprint, missing)):
+                    self.entries[relpaths[path]] = keys[path]+(sha1,)
+            self.changed = True
+        return {path: self.entries[relpaths[path]][2] for path in image_paths}
+
+    def save(self):
+        if not self.changed: return
+        try:
+            rows = [(relpath,)+entry for relpath,entry in sorted(self.entries.items())]
+            atomic_write(self.path, lambda f: csv.writer(f).writerows(rows), mode='w')
+            self.changed = False
+        except OSError as e:
+            print('WARNING: image hashes could not be cached to {} ({})'.format(self.path, e))
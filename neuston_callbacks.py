@@ -1,13 +1,18 @@
 """this module handles the logging of data from epochs"""
 
 # built in imports
+import io
 import json
 import os
+import threading
 
 # 3rd party imports
 import h5py as h5
 import numpy as np
+import torch
 import pytorch_lightning as ptl
+from pytorch_lightning.callbacks import ModelCheckpoint
+from pytorch_lightning.utilities.apply_func import apply_to_collection
 from scipy.io import savemat
 from sklearn import metrics
 
@@ -17,13 +22,63 @@ from neuston_data import IfcbBinDataset
 
 ## Training ##
 
+class WriterThread(threading.Thread):
+    """Background file writer. An exception raised by target is kept, and re-raised when the thread is joined"""
+
+    def __init__(self, target, args=()):
+        super().__init__(target=target, args=args)
+        self.error = None
+
+    def run(self):
+        try: super().run()
+        except BaseException as e: self.error = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if self.error is not None: raise self.error
+
+
 class SaveValidationResults(ptl.callbacks.base.Callback):
+    """Writes validation results of best epochs.
+       Series that do not change between epochs (class labels, training images, counts) are computed and serialized once per run,
+       and files are written in a background thread that is joined before the next write."""
+
+    STATIC_SERIES = ['class_labels', 'training_image_fullpaths', 'training_image_basenames', 'training_classes',
+                     'counts_perclass', 'val_counts_perclass', 'train_counts_perclass']
 
     def __init__(self, outdir, outfile, series, best_only=True):
         self.outdir = outdir
         self.outfile = outfile
         self.series = series
         self.best_only = best_only
+        self.static = None          # static series of the validated dataset with id static_key
+        self.static_key = None
+        self.static_serialized = {}  # file extension: serialized static series
+        self.h5_outfile = None       # latest .h5 file written, its static series need not be rewritten
+        self.writer = None
+
+    def join(self):
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.join()
+
+    def on_train_end(self, trainer, pl_module):
+        self.join()
+
+    def static_series(self, pl_module, val_dataset):
+        train_dataset = pl_module.train_dataloader().dataset
+        val_counts_perclass = val_dataset.count_perclass
+        train_counts_perclass = train_dataset.count_perclass
+        counts_perclass = [vcount+tcount for vcount,tcount in zip(val_counts_perclass, train_counts_perclass)] # element-wise addition
+        training_image_fullpaths = train_dataset.images
+        static = dict(class_labels=pl_module.hparams.classes,
+                      training_image_fullpaths=training_image_fullpaths,
+                      training_image_basenames=[os.path.splitext(os.path.basename(img))[0] for img in training_image_fullpaths],
+                      training_classes=train_dataset.targets,
+                      counts_perclass=counts_perclass,
+                      val_counts_perclass=val_counts_perclass,
+                      train_counts_perclass=train_counts_perclass)
+        return static
 
     def on_validation_end(self, trainer, pl_module):
         log = trainer.callback_metrics # flattened dict
@@ -31,19 +86,22 @@ class SaveValidationResults(ptl.callbacks.base.Callback):
 
         if not(log['best'] or not self.best_only):
             return
+        if not trainer.is_global_zero:  # results are gathered, every process has them
+            return
 
         curr_epoch = pl_module.current_epoch
         class_labels = pl_module.hparams.classes
         class_idxs = list(range(len(class_labels)))
 
-        val_dataset = pl_module.val_dataloader().dataset
-        train_dataset = pl_module.train_dataloader().dataset
-        val_counts_perclass = val_dataset.count_perclass
-        train_counts_perclass = train_dataset.count_perclass
-        counts_perclass = [vcount+tcount for vcount,tcount in zip(val_counts_perclass, train_counts_perclass)] # element-wise addition
-        training_image_fullpaths = train_dataset.images
-        training_image_basenames = [os.path.splitext(os.path.basename(img))[0] for img in training_image_fullpaths]
-        training_classes = train_dataset.targets
+        # static series, once per run (and per validated dataset, see TRAIN --val-subset)
+        val_dataset = pl_module.validated_dataset if pl_module.validated_dataset is not None else pl_module.val_dataloader().dataset
+        if self.static_key != id(val_dataset):
+            self.join()
+            self.static = self.static_series(pl_module, val_dataset)
+            self.static_key = id(val_dataset)
+            self.static_serialized = {}
+            self.h5_outfile = None
+        counts_perclass = self.static['counts_perclass']
 
         output_scores = log['outputs']
         output_winscores = np.max(output_scores, axis=1)
@@ -78,24 +136,17 @@ class SaveValidationResults(ptl.callbacks.base.Callback):
         # default values
         results = dict(model_id=pl_module.hparams.model_id,
                        timestamp=pl_module.hparams.cmd_timestamp,
-                       class_labels=class_labels,
                        input_classes=input_classes,
                        output_classes=output_classes)
 
         # optional values
         if 'image_fullpaths' in self.series: results['image_fullpaths'] = image_fullpaths
         if 'image_basenames' in self.series: results['image_basenames'] = image_basenames
-        if 'training_image_fullpaths' in self.series: results['training_image_fullpaths'] = training_image_fullpaths
-        if 'training_image_basenames' in self.series: results['training_image_basenames'] = training_image_basenames
-        if 'training_classes' in self.series: results['training_classes'] = training_classes
         if 'output_winscores' in self.series: results['output_winscores'] = output_winscores
         if 'output_scores' in self.series: results['output_scores'] = output_scores
         if 'confusion_matrix' in self.series :
             results['confusion_matrix'] = confusion_matrix
             #results['classes_by_recall'] = classes_by['recall'] # no longer included with cm
-        if 'counts_perclass' in self.series: results['counts_perclass'] = counts_perclass
-        if 'val_counts_perclass' in self.series: results['val_counts_perclass'] = val_counts_perclass
-        if 'train_counts_perclass' in self.series: results['val_counts_perclass'] = val_counts_perclass
 
         # optional stats and class_by's
         for stat in stats: # eg f1_weighted, recall_perclass
@@ -104,11 +155,16 @@ class SaveValidationResults(ptl.callbacks.base.Callback):
             classes_by_stat = 'classes_by_'+stat
             if classes_by_stat in self.series: results[classes_by_stat] = classes_by[stat]
 
-        # sendit!
+        # sendit! in the background, while training continues
         outfile = os.path.join(self.outdir,self.outfile).format(epoch=curr_epoch)
-        if log['best'] or not self.best_only:
-            os.makedirs(os.path.dirname(outfile), exist_ok=True)
-            self.save_validation_results(outfile, results)
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        self.join()
+        self.writer = WriterThread(target=self.save_validation_results, args=(outfile, results))
+        self.writer.start()
+
+    @property
+    def static_results(self):
+        return {series:value for series,value in self.static.items() if series=='class_labels' or series in self.series}
 
     def save_validation_results(self, outfile, results):
         if outfile.endswith('.json'): self._save_validation_results_json(outfile,results)
@@ -116,27 +172,38 @@ class SaveValidationResults(ptl.callbacks.base.Callback):
         if outfile.endswith('.h5'): self._save_validation_results_hdf(outfile,results)
 
     def _save_validation_results_json(self,outfile,results):
-        for series in results: # convert numpy arrays to list
-            if isinstance(results[series], np.ndarray):
-                results[series] = results[series].tolist()
+        def to_lists(results):
+            return {series: value.tolist() if isinstance(value, np.ndarray) else value for series,value in results.items()}
+        if '.json' not in self.static_serialized:
+            self.static_serialized['.json'] = json.dumps(to_lists(self.static_results))[1:-1]  # '"series": value, ...'
         # write json file
         with open(outfile, 'w') as f:
-            json.dump(results, f)
+            f.write('{' + json.dumps(to_lists(results))[1:-1] + ', ' + self.static_serialized['.json'] + '}')
 
-    def _save_validation_results_mat(self,outfile,results):
+    def _mat_series(self, results):
         # index ints
         idx_data = ['input_classes','output_classes','training_classes']
         idx_data += ['classes_by_'+stat for stat in 'f1 recall precision count'.split()]
         str_data = ['class_labels','image_fullpaths','image_basenames','training_image_fullpaths','training_image_basenames']
 
+        results = dict(results)
         for series in results:
             if isinstance(results[series], np.ndarray): results[series] = results[series].astype('f4')
             elif isinstance(results[series], np.float64): results[series] = results[series].astype('f4')
             elif series in str_data: results[series] = np.asarray(results[series], dtype='object')
             elif series in idx_data: results[series] = np.asarray(results[series]).astype('u4') + 1
             # matlab is not zero-indexed, so increment all the indicies by 1
+        return results
 
-        savemat(outfile, results, do_compression=True)
+    def _save_validation_results_mat(self,outfile,results):
+        # a .mat file is a 128 byte header followed by its variables, so compressed static variables can be appended as-is
+        if '.mat' not in self.static_serialized:
+            buffer = io.BytesIO()
+            savemat(buffer, self._mat_series(self.static_results), do_compression=True)
+            self.static_serialized['.mat'] = buffer.getvalue()[128:]
+        with open(outfile, 'wb') as f:
+            savemat(f, self._mat_series(results), do_compression=True)
+            f.write(self.static_serialized['.mat'])
 
     def _save_validation_results_hdf(self,outfile,results):
         attrib_data = ['model_id', 'timestamp']
@@ -145,19 +212,97 @@ class SaveValidationResults(ptl.callbacks.base.Callback):
         int_data += 'counts_perclass val_counts_perclass train_counts_perclass'.split()
         int_data += ['classes_by_'+stat for stat in 'f1 recall precision count'.split()]
         string_data = ['class_labels', 'image_fullpaths', 'image_basenames', 'training_image_fullpaths', 'training_image_basenames']
-        with h5.File(outfile, 'w') as f:
-            meta = f.create_dataset('metadata', data=h5.Empty('f'))
+
+        # the static series of a file written earlier this run are kept, only changing series are overwritten.
+        # they are overwritten in place, as HDF5 does not reclaim the space of deleted datasets
+        rewrite = outfile == self.h5_outfile and os.path.isfile(outfile)
+        if not rewrite: results = dict(results, **self.static_results)
+        with h5.File(outfile, 'r+' if rewrite else 'w') as f:
+            meta = f['metadata'] if rewrite else f.create_dataset('metadata', data=h5.Empty('f'))
             for series in results:
+                if rewrite and series in f:
+                    data = np.string_(results[series]) if series in string_data else np.asarray(results[series])
+                    if f[series].shape == data.shape:
+                        f[series][...] = data
+                        continue
+                    del f[series]
                 if series in attrib_data: meta.attrs[series] = results[series]
                 elif series in string_data: f.create_dataset(series, data=np.string_(results[series]), compression='gzip', dtype=h5.string_dtype())
                 elif series in int_data: f.create_dataset(series, data=results[series], compression='gzip', dtype='int16')
                 elif isinstance(results[series],np.ndarray):
                     f.create_dataset(series, data=results[series], compression='gzip', dtype='float16')
                 else: raise UserWarning('hdf results: WE MISSED THIS ONE: {}'.format(series))
+        self.h5_outfile = outfile
+
+
+class AsyncModelCheckpoint(ModelCheckpoint):
+    """ModelCheckpoint that writes checkpoint files in a background thread. The checkpoint is copied to cpu memory
+       synchronously, so training may continue while it is written. A write is joined before the next one starts"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer = None
+
+    def join(self):
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.join()
+
+    def on_pretrain_routine_start(self, trainer, pl_module):
+        super().on_pretrain_routine_start(trainer, pl_module)
+        save_checkpoint = trainer.accelerator.save_checkpoint
+
+        def save_function(filepath, weights_only=False):
+            checkpoint = trainer.checkpoint_connector.dump_checkpoint(weights_only)
+            checkpoint = apply_to_collection(checkpoint, torch.Tensor, lambda tensor: tensor.detach().cpu().clone())
+            self.join()
+            self.writer = WriterThread(target=save_checkpoint, args=(checkpoint, filepath))
+            self.writer.start()
+        self.save_function = save_function
+
+    def on_train_end(self, trainer, pl_module):
+        self.join()
+
+
+class StagedUnfreezing(ptl.callbacks.base.Callback):
+    """Starting from frozen_groups frozen layer groups, unfreezes the deepest frozen layer group every `epochs` epochs"""
+
+    def __init__(self, frozen_groups, epochs):
+        self.frozen_groups = frozen_groups
+        self.epochs = epochs
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        frozen_groups = max(0, self.frozen_groups - pl_module.current_epoch//self.epochs)
+        pl_module.freeze_layer_groups(frozen_groups)
+
+
+class ProgressiveResize(ptl.callbacks.base.Callback):
+    """Trains at each (size, epochs) phase's resolution in turn, then at full_size. Validation is always at full resolution.
+       The training dataset's transforms are rebuilt by make_transforms(size) at the start of each phase."""
+
+    def __init__(self, dataset, phases, make_transforms, full_size):
+        self.dataset = dataset
+        self.phases = phases
+        self.make_transforms = make_transforms
+        self.full_size = full_size
+        self.size = None
+
+    def size_at(self, epoch):
+        for size, epochs in self.phases:
+            if epoch < epochs: return size
+            epoch -= epochs
+        return self.full_size
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        size = self.size_at(pl_module.current_epoch)
+        if size != self.size:
+            self.dataset.transforms = self.make_transforms(size)
+            self.size = size
+            print('Epoch {}: training at {}x{}'.format(pl_module.current_epoch, size, size))
 
 
 ## Running ##
-def save_run_results(input_images, output_scores, class_labels, timestamp, outdir, outfile, model_id=None, input_obj=None):
+def save_run_results(input_images, output_scores, class_labels, timestamp, outdir, outfile, model_id=None, input_obj=None, output_stages=None, prefiltered=None, prefilter=None):
     output_classranks = np.max(output_scores, axis=1)
     output_classes = np.argmax(output_scores, axis=1)
 
@@ -171,12 +316,17 @@ def save_run_results(input_images, output_scores, class_labels, timestamp, outdi
                    input_images=input_images,
                    output_classes=output_classes,
                    output_scores=output_scores)
+    if output_stages is not None:
+        results['output_stages'] = output_stages  # 0: cascade screening model, 1: full model, 255: prefiltered
+    if prefiltered is not None:
+        results['prefiltered'] = prefiltered  # inputs assigned to a class by size alone, not scored by the model
+        results['prefilter'] = prefilter      # min_width, min_height, class_label
 
     outfile = os.path.join(outdir, outfile)
     if isinstance(input_obj,ifcb.Pid):
         bin_obj = input_obj
         results['bin_id'] = bin_obj.pid
-        results['roi_numbers'] = [ifcb.Pid(img).target for img in input_images]
+        results['roi_numbers'] = np.asarray(input_images, dtype='u4')  # bin inputs are roi numbers
         outfile_dict = dict(BIN_ID=bin_obj.pid, INPUT_SUBDIRS=bin_obj.namespace,
                             BIN_YEAR=bin_obj.year, BIN_DATE=bin_obj.yearday)
         outfile = outfile.format(**outfile_dict).replace(2*os.sep,os.sep)
@@ -186,19 +336,24 @@ def save_run_results(input_images, output_scores, class_labels, timestamp, outdi
         if '{INPUT_SUBDIRS}' in outfile:
             dir_groups = {}
             input_src = input_obj if os.path.isdir(input_obj) else ''
-            for img_path,img_classidx,img_scores in zip(input_images,output_classes,output_scores):
+            per_image = ['input_images','output_classes','output_scores','output_stages']
+            for idx,(img_path,img_classidx,img_scores) in enumerate(zip(input_images,output_classes,output_scores)):
                 parent_dir = os.path.dirname(img_path.replace(input_src, ''))#+os.sep
 
                 if parent_dir not in dir_groups:
-                    dir_groups[parent_dir] = {k: v if k not in ['input_images','output_classes','output_scores'] else [] for k,v in results.items()}
+                    dir_groups[parent_dir] = {k: v if k not in per_image else [] for k,v in results.items()}
                 dir_groups[parent_dir]['input_images'].append(os.path.basename(img_path))
                 dir_groups[parent_dir]['output_classes'].append(img_classidx)
                 dir_groups[parent_dir]['output_scores'].append(img_scores)
+                if output_stages is not None:
+                    dir_groups[parent_dir]['output_stages'].append(output_stages[idx])
             for parent_dir,sub_results in dir_groups.items():
                 sub_outfile = outfile.format(INPUT_SUBDIRS=parent_dir)
                 os.makedirs(os.path.dirname(sub_outfile),exist_ok=True)
                 sub_results['output_classes'] = np.asarray(sub_results['output_classes'], dtype=results['output_classes'].dtype)
                 sub_results['output_scores'] = np.asarray(sub_results['output_scores'], dtype=results['output_scores'].dtype)
+                if output_stages is not None:
+                    sub_results['output_stages'] = np.asarray(sub_results['output_stages'], dtype='u1')
                 _save_run_results(sub_outfile, sub_results)
 
         else: #easy
@@ -206,28 +361,37 @@ def save_run_results(input_images, output_scores, class_labels, timestamp, outdi
             _save_run_results(outfile, results)
 
 
+def run_results_json(results):
+    """json-serializable run results, as written to .json OUTFILEs"""
+    # results: model_id timestamp class_labels (bin + roi_numbers)
+    #          input_images output_classes output_scores
+
+    output = dict(version = results['version'],
+                  model_id = results['model_id'],
+                  timestamp = results['timestamp'],
+                  class_labels = results['class_labels'],
+                  output_scores = results['output_scores'].tolist(),
+                  output_classes = results['output_classes'].tolist() )
+    if 'output_stages' in results:
+        output['output_stages'] = np.asarray(results['output_stages']).tolist()
+    if 'prefiltered' in results:
+        output['prefiltered'] = np.asarray(results['prefiltered']).tolist()
+        output['prefilter'] = results['prefilter']
+    if 'bin_id' in results:
+        output['bin_id'] = results['bin_id']
+        output['roi_numbers'] = np.asarray(results['roi_numbers']).tolist()
+    else:
+        output['input_images'] = results['input_images']
+    return output
+
+
 def _save_run_results(outfile, results):
     # handles .json, .mat, .h5 files
     ext = os.path.splitext(outfile)[-1]
     assert ext in ['.json','.mat','.h5'], 'output fileformat "{}" not valid'.format(ext)
     def _save_run_results_json(outfile, results):
-        # results: model_id timestamp class_labels (bin + roi_numbers)
-        #          input_images output_classes output_scores
-
-        output = dict(version = results['version'],
-                      model_id = results['model_id'],
-                      timestamp = results['timestamp'],
-                      class_labels = results['class_labels'],
-                      output_scores = results['output_scores'].tolist(),
-                      output_classes = results['output_classes'].tolist() )
-        if 'bin_id' in results:
-            output['bin_id'] = results['bin_id']
-            output['roi_numbers'] = results['roi_numbers']
-        else:
-            output['input_images'] = results['input_images']
-
         with open(outfile, 'w') as f:
-            json.dump(output, f)
+            json.dump(run_results_json(results), f)
 
     def _save_run_results_mat(outfile, results):
         # results: model_id timestamp class_labels (bin + roi_numbers)
@@ -241,6 +405,11 @@ def _save_run_results(outfile, results):
         output['timestamp'] = results['timestamp']
         output['output_scores'] = results['output_scores'].astype('f4')
         output['class_labels'] = np.asarray(results['class_labels'], dtype='object')
+        if 'output_stages' in results:
+            output['output_stages'] = np.asarray(results['output_stages'], dtype='u1')
+        if 'prefiltered' in results:
+            output['prefiltered'] = np.asarray(results['prefiltered'], dtype='u1')
+            output['prefilter'] = results['prefilter']
         if 'bin_id' in results:
             output['bin_id'] = results['bin_id']
             output['roi_numbers'] = results['roi_numbers']#.astype('u4') #not numpy yet, but thats fine it seems
@@ -261,6 +430,12 @@ def _save_run_results(outfile, results):
             f.create_dataset('output_classes', data=results['output_classes'], compression='gzip', dtype='float16')
             f.create_dataset('output_scores', data=results['output_scores'], compression='gzip', dtype='float16')
             f.create_dataset('class_labels', data=np.string_(results['class_labels']), compression='gzip', dtype=h5.string_dtype())
+            if 'output_stages' in results:
+                f.create_dataset('output_stages', data=results['output_stages'], compression='gzip', dtype='uint8')
+            if 'prefiltered' in results:
+                f.create_dataset('prefiltered', data=results['prefiltered'], compression='gzip', dtype='uint8')
+                for key,value in results['prefilter'].items():
+                    meta.attrs['prefilter_'+key] = value
             if results['bin_id']:
                 meta.attrs['bin_id'] = results['bin_id']
                 f.create_dataset('roi_numbers', data=results['roi_numbers'], compression='gzip', dtype='uint16')
@@ -274,23 +449,152 @@ def _save_run_results(outfile, results):
 
 class SaveTestResults(ptl.callbacks.base.Callback):
 
-    def __init__(self, outdir, outfile, timestamp):
+    def __init__(self, outdir, outfile, timestamp, model_id=None):
         self.outdir = outdir
         self.outfile = outfile
         self.timestamp = timestamp
+        self.model_id = model_id  # if set, only RunResults of this model are saved
+
+    def on_test_end(self, trainer, pl_module):
+
+        RRs = trainer.callback_metrics['RunResults']
+        # RunResult rr: inputs, outputs, input_obj, model_id, class_labels
+        if not isinstance(RRs,list):
+            RRs = [RRs]
+
+        for rr in RRs:
+            self.save(rr)
+
+    def save(self, rr):
+        if self.model_id and rr.model_id != self.model_id: return
+        save_run_results(rr.inputs, rr.outputs, rr.class_labels, self.timestamp, self.outdir, self.outfile, rr.model_id, rr.input_obj,
+                         rr.output_stages, rr.prefiltered, rr.prefilter)
+
+
+class SaveEnsembleResults(ptl.callbacks.base.Callback):
+    """Averages the scores of several models once every model has RunResults for a given bin or image set"""
+
+    def __init__(self, model_ids, outdir, outfiles, timestamp, ensemble_id):
+        self.model_ids = set(model_ids)
+        self.outdir = outdir
+        self.outfiles = outfiles
+        self.timestamp = timestamp
+        self.ensemble_id = ensemble_id
+        self.pending = {}  # str(input_obj): {model_id: rr}
 
     def on_test_end(self, trainer, pl_module):
+        RRs = trainer.callback_metrics['RunResults']
+        if not isinstance(RRs,list):
+            RRs = [RRs]
+
+        for rr in RRs:
+            self.save(rr)
+
+    def save(self, rr):
+        if rr.model_id not in self.model_ids: return
+        input_RRs = self.pending.setdefault(str(rr.input_obj), {})
+        input_RRs[rr.model_id] = rr
+        if set(input_RRs) != self.model_ids: return
+
+        del self.pending[str(rr.input_obj)]
+        output_scores = np.mean([model_rr.outputs for model_rr in input_RRs.values()], axis=0)
+        for outfile in self.outfiles:
+            save_run_results(rr.inputs, output_scores, rr.class_labels, self.timestamp, self.outdir, outfile, self.ensemble_id, rr.input_obj,
+                             prefiltered=rr.prefiltered, prefilter=rr.prefilter)
 
+
+class SaveScoreCache(ptl.callbacks.base.Callback):
+
+    def __init__(self, score_cache):
+        self.score_cache = score_cache
+
+    def on_test_end(self, trainer, pl_module):
         RRs = trainer.callback_metrics['RunResults']
-        # RunResult rr: inputs, outputs, bin_id
         if not isinstance(RRs,list):
             RRs = [RRs]
 
         for rr in RRs:
-            input_obj = rr.input_obj
-            output_scores = rr.outputs
-            input_images = rr.inputs
-            model_id = pl_module.hparams.model_id
-            class_labels = pl_module.hparams.classes
+            if rr.type != 'Bin' or rr.model_id != self.score_cache.model_id: continue
+            roi_numbers = rr.inputs
+            self.score_cache.put(rr.input_obj.pid, roi_numbers, rr.outputs)
+
+
+class SaveFeatureResults(ptl.callbacks.base.Callback):
+    """
+    Appends penultimate-layer features of bin RunResults to a memory-mappable feature store in outdir/features/
+      features.f16     float16 array of shape (num_rois, dim), raw and row-major
+      roi_numbers.u32  uint32 array of shape (num_rois,), the roi number of each feature row
+      bins.csv         bin_id,start,count index of feature rows
+      features.json    model_id, dim, dtype
+    See load_features()
+    """
+    def __init__(self, outdir, model_id):
+        self.feature_dir = os.path.join(outdir, 'features')
+        self.model_id = model_id
+        self.dim = None
+        self.indexed_bins = set()
+        os.makedirs(self.feature_dir, exist_ok=True)
+        header_file = os.path.join(self.feature_dir, 'features.json')
+        if os.path.isfile(header_file):
+            with open(header_file) as f:
+                self.dim = json.load(f)['dim']
+            with open(os.path.join(self.feature_dir, 'bins.csv')) as f:
+                self.indexed_bins = {line.split(',')[0] for line in f.read().splitlines()[1:]}
+
+    def has(self, bin_id):
+        return bin_id in self.indexed_bins
+
+    def on_test_end(self, trainer, pl_module):
+        RRs = trainer.callback_metrics['RunResults']
+        if not isinstance(RRs,list):
+            RRs = [RRs]
 
-            save_run_results(input_images, output_scores, class_labels, self.timestamp, self.outdir, self.outfile, model_id, input_obj)
+        for rr in RRs:
+            if rr.type != 'Bin' or rr.model_id != self.model_id or rr.features is None: continue
+            self.save(rr.input_obj.pid, rr.inputs, rr.features)
+
+    def save(self, bin_id, roi_numbers, features):
+        if self.dim is None:
+            self.dim = features.shape[1]
+            with open(os.path.join(self.feature_dir, 'features.json'), 'w') as f:
+                json.dump(dict(model_id=self.model_id, dim=self.dim, dtype='float16'), f)
+            with open(os.path.join(self.feature_dir, 'bins.csv'), 'w') as f:
+                f.write('bin_id,start,count\n')
+        assert features.shape[1] == self.dim, 'feature dimension mismatch: {} vs {}'.format(features.shape[1], self.dim)
+
+        # rows are appended, then indexed. Rows orphaned by an interrupted run are never indexed.
+        feature_file = os.path.join(self.feature_dir, 'features.f16')
+        roi_file = os.path.join(self.feature_dir, 'roi_numbers.u32')
+        feature_rows = os.path.getsize(feature_file)//(2*self.dim) if os.path.isfile(feature_file) else 0
+        roi_rows = os.path.getsize(roi_file)//4 if os.path.isfile(roi_file) else 0
+        start = min(feature_rows, roi_rows)
+        # realign after an interrupted write, partial rows included
+        for path, row_bytes in [(feature_file, 2*self.dim), (roi_file, 4)]:
+            if os.path.isfile(path) and os.path.getsize(path) != start*row_bytes:
+                with open(path, 'r+b') as f: f.truncate(start*row_bytes)
+        with open(feature_file, 'ab') as f:
+            f.write(np.ascontiguousarray(features, dtype='<f2').tobytes())
+        with open(roi_file, 'ab') as f:
+            f.write(np.asarray(roi_numbers, dtype='<u4').tobytes())
+        with open(os.path.join(self.feature_dir, 'bins.csv'), 'a') as f:
+            f.write('{},{},{}\n'.format(bin_id, start, len(roi_numbers)))
+        self.indexed_bins.add(bin_id)
+
+
+def load_features(feature_dir):
+    """
+    Returns (features, roi_numbers, bins) from a SaveFeatureResults feature store.
+    features and roi_numbers are read-only memory-maps, bins is a {bin_id: slice} dict of their rows.
+    If a bin was indexed more than once, its last entry is used.
+    """
+    with open(os.path.join(feature_dir, 'features.json')) as f:
+        dim = json.load(f)['dim']
+    bins = dict()
+    with open(os.path.join(feature_dir, 'bins.csv')) as f:
+        for line in f.read().splitlines()[1:]:
+            bin_id, start, count = line.split(',')
+            bins[bin_id] = slice(int(start), int(start)+int(count))
+    num_rows = max([s.stop for s in bins.values()], default=0)
+    features = np.memmap(os.path.join(feature_dir, 'features.f16'), dtype='<f2', mode='r', shape=(num_rows, dim))
+    roi_numbers = np.memmap(os.path.join(feature_dir, 'roi_numbers.u32'), dtype='<u4', mode='r', shape=(num_rows,))
+    return features, roi_numbers, bins
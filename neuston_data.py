@@ -2,28 +2,42 @@
 
 # built in imports
 import os, sys
+import io
 import random
+import copy
+import time
+import tarfile
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # 3rd party imports
 from torchvision import transforms, datasets
 from torch.utils.data.dataset import Dataset, IterableDataset
+from torch.utils.data import get_worker_info
 from torch import Tensor
+import torch
+import torch.distributed as dist
 import pandas as pd
+from PIL import Image
 
 # project imports
 import ifcb
 from ifcb.data.adc import SCHEMA_VERSION_1
 from ifcb.data.stitching import InfilledImages
+from ifcb.data.files import Fileset, FilesetBin
+from neuston_cache import ImageHashCache
 
 
 ## TRAINING ##
 
 class NeustonDataset(Dataset):
 
-    def __init__(self, src, minimum_images_per_class=1, maximum_images_per_class=None, transforms=None, images_perclass=None):
+    def __init__(self, src, minimum_images_per_class=1, maximum_images_per_class=None, transforms=None, images_perclass=None, dedup=False):
         self.src = src
         if not images_perclass:
-            images_perclass = self.fetch_images_perclass(src)
+            images_perclass = self.fetch_images_perclass(src, dedup=dedup)
 
         # CLASS MINIMUM CUTTOFF
         self.minimum_images_per_class = max(1, minimum_images_per_class)  # always at least 1.
@@ -52,8 +66,8 @@ class NeustonDataset(Dataset):
         self.transforms = transforms
 
     @classmethod
-    def fetch_images_perclass(cls, src, include_exclude_rename=None):
-        """ folders in src are the classes """
+    def fetch_images_perclass(cls, src, include_exclude_rename=None, dedup=False):
+        """ folders in src are the classes. With dedup, images duplicated across a dataset-config's datasets are only kept once """
         # TODO implement SRC as a config file that can combine classes from multiple datasets.
         #      datasets may have different priority levels (relevant for class-max option that happens outside of this function)
 
@@ -112,7 +126,9 @@ class NeustonDataset(Dataset):
             # assigning non-prioritized datasets to the max+1 priority (last)
             priorities = [p for p,d,i in datasets_by_priority]
             priorities = set([max(priorities)+1 if p==0 else p for p in priorities])
-            datasets_by_priority = (( (max(priorities) if p==0 else p) ,d,i) for p,d,i in datasets_by_priority)
+            datasets_by_priority = [( (max(priorities) if p==0 else p) ,d,i) for p,d,i in datasets_by_priority]
+            if dedup:
+                datasets_by_priority = dedup_datasets_by_priority(datasets_by_priority)
 
             images_perclass = dict()
             def extend_dol(d1,d2):
@@ -177,21 +193,32 @@ class NeustonDataset(Dataset):
             d2_perclass[class_label] = d2_images
 
         #4) create and return new datasets
-        dataset1 = NeustonDataset(src=self.src, images_perclass=d1_perclass, transforms=self.transforms)
-        dataset2 = NeustonDataset(src=self.src, images_perclass=d2_perclass, transforms=self.transforms)
+        dataset1 = self.subset(d1_perclass)
+        dataset2 = self.subset(d2_perclass)
         assert dataset1.classes == dataset2.classes, 'd1-d2_classes:{}, d2-d1_classes:{}'.format(set(dataset1.classes)-set(dataset2.classes), set(dataset2.classes)-set(dataset1.classes))  # possibly fails due to edge case thresholding?
         assert len(dataset1)+len(dataset2) == len(self), 'd1_len:{}, d2_len:{}'.format(len(dataset1),len(dataset2))  # make sure we don't lose any images somewhere
         return dataset1, dataset2
 
+    def subsample(self, percent, seed=None):
+        """A stratified subset of percent% of each class's images, and at least one image per class"""
+        rng = random.Random(seed)
+        images_perclass = {label: sorted(rng.sample(images, max(1, int(percent*len(images)/100+0.5))))
+                           for label, images in self.images_perclass.items()}
+        return self.subset(images_perclass)
+
+    def subset(self, images_perclass):
+        """A dataset of the same kind and src, of just images_perclass"""
+        return type(self)(src=self.src, images_perclass=images_perclass, transforms=self.transforms)
+
     @classmethod
-    def from_csv(cls, src, csv_file, column_to_run, transforms=None, minimum_images_per_class=1, maximum_images_per_class=None):
+    def from_csv(cls, src, csv_file, column_to_run, transforms=None, minimum_images_per_class=1, maximum_images_per_class=None, dedup=False):
         #1) load csv
         df = pd.read_csv(csv_file, header=0)
         base_list = df.iloc[:,0].tolist()      # first column
         mod_list = df[column_to_run].tolist()  # chosen column
 
         #2) get list of files
-        default_images_perclass = cls.fetch_images_perclass(src)
+        default_images_perclass = cls.fetch_images_perclass(src, dedup=dedup)
         missing_classes_src = [c for c in default_images_perclass if c not in base_list]
 
         #3) for classes in column to run, keep 1's, dump 0's, combine named
@@ -270,6 +297,242 @@ class NeustonDataset(Dataset):
         return self.images
 
 
+def dedup_datasets_by_priority(datasets_by_priority, max_reported=20):
+    """
+    Removes duplicate images from (priority,dataset,images_perclass) tuples, by content hash.
+    The copy of the highest priority (lowest number, then leftmost column) dataset is kept.
+    Duplicates with differing labels are reported as conflicts. Hashes are cached per dataset by ImageHashCache.
+    """
+    seen = dict()  # hash: (dataset, label, image)
+    deduped, duplicates, conflicts = [], 0, []
+    for priority,dataset,images_perclass in sorted(datasets_by_priority, key=lambda pdi: pdi[0]):
+        hash_cache = ImageHashCache(dataset)
+        hashes = hash_cache.hashes([img for images in images_perclass.values() for img in images])
+        hash_cache.save()
+        kept_perclass = dict()
+        for label in sorted(images_perclass):
+            kept_perclass[label] = []
+            for img in images_perclass[label]:
+                if hashes[img] not in seen:
+                    seen[hashes[img]] = (dataset,label,img)
+                    kept_perclass[label].append(img)
+                    continue
+                duplicates += 1
+                if seen[hashes[img]][1] != label:
+                    conflicts.append((seen[hashes[img]], (dataset,label,img)))
+        deduped.append((priority,dataset,kept_perclass))
+
+    print('Dedup: {} duplicate images removed, {} with conflicting labels'.format(duplicates, len(conflicts)))
+    for (_,kept_label,kept_img),(_,label,img) in conflicts[:max_reported]:
+        print('    {} ({}) kept over {} ({})'.format(kept_img, kept_label, img, label))
+    if len(conflicts) > max_reported:
+        print('    ...and {} more conflicts'.format(len(conflicts)-max_reported))
+    return deduped
+
+
+class StreamingDataset(NeustonDataset, IterableDataset):
+    """
+    A NeustonDataset whose images are read sequentially, group by group (eg tar shards), instead of opened one at a time.
+    Group order is shuffled every epoch and images are shuffled within a buffer of shuffle_buffer images.
+    Class min/max limiting, split and seed behave as for NeustonDataset.
+    Subclasses implement fetch_images_perclass, group_of and read_group.
+    """
+    shuffle = True
+    shuffle_buffer = 1000
+
+    def subset(self, images_perclass):
+        dataset = super().subset(images_perclass)
+        dataset.shuffle = self.shuffle
+        dataset.shuffle_buffer = self.shuffle_buffer
+        return dataset
+
+    def group_of(self, image):
+        raise NotImplementedError
+
+    def read_group(self, group):
+        """yields (image, PIL_image) for the images of group, in on-disk order"""
+        raise NotImplementedError
+
+    def __iter__(self):
+        targets = dict(zip(self.images, self.targets))
+        groups = sorted(set(self.group_of(image) for image in self.images))
+
+        # all workers and processes agree on this epoch's group order, and each reads its own portion of it
+        worker_info = get_worker_info()
+        if worker_info is None:
+            seed, worker, num_workers = int(torch.randint(2**31, (1,))), 0, 1
+        else:
+            seed, worker, num_workers = worker_info.seed-worker_info.id, worker_info.id, worker_info.num_workers
+        rank, world_size = 0, 1
+        if self.shuffle and dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        if self.shuffle:
+            random.Random(seed).shuffle(groups)
+        part, num_parts = rank*num_workers+worker, world_size*num_workers
+        keep = None
+        if len(groups) >= num_parts:
+            groups = groups[part::num_parts]  # every group holds images of this dataset, so no portion is empty
+        else:
+            # fewer groups than parts, eg few shards and many ranks x loaders. Every part reads all groups and keeps its share of images
+            keep = set(image for idx,image in enumerate(sorted(self.images)) if idx%num_parts == part)
+        # distributed processes must see the same number of images, so portions are cycled or cut to an equal quota
+        quota = None
+        if world_size > 1:
+            quota = len(self)//num_parts
+            assert quota > 0, 'fewer images ({}) than dataset readers ({} processes x {} loaders)'.format(len(self), world_size, num_workers)
+
+        def stream():
+            count = 0
+            while True:
+                for group in groups:
+                    for image, img in self.read_group(group):
+                        if image not in targets: continue  # not part of this dataset, eg other side of a split
+                        if keep is not None and image not in keep: continue
+                        yield image, img
+                        count += 1
+                        if count == quota: return
+                if quota is None: return
+                if count == 0:
+                    raise RuntimeError('no images were read from groups {}, the dataset index does not match its groups'.format(groups))
+
+        def transformed(image, img):
+            if self.transforms is not None:
+                img = self.transforms(img)
+            return img, targets[image], image
+
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            for image, img in stream():
+                yield transformed(image, img)
+            return
+
+        rng = random.Random(seed+part)
+        buffer = []
+        for item in stream():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            idx = rng.randrange(len(buffer))
+            buffer[idx], item = item, buffer[idx]
+            yield transformed(*item)
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield transformed(*item)
+
+
+class ShardedDataset(StreamingDataset):
+    """
+    Images packed into sequential tar shards by "neuston_util.py PACK", streamed shard by shard.
+    src is a PACK output directory of shard-NNNNN.tar files and a shards.csv index of image,label,shard,member rows.
+    Images keep their original paths as identifiers, eg in training_images.list and result files.
+    """
+    INDEX = 'shards.csv'
+    SHARD_PATTERN = 'shard-{:05d}.tar'
+
+    @classmethod
+    def is_shard_dir(cls, src):
+        return os.path.isdir(src) and os.path.isfile(os.path.join(src, cls.INDEX))
+
+    @classmethod
+    def read_index(cls, src):
+        return pd.read_csv(os.path.join(src, cls.INDEX), header=0, dtype=str)
+
+    @classmethod
+    def fetch_images_perclass(cls, src, include_exclude_rename=None, dedup=False):
+        if include_exclude_rename is not None:
+            return super().fetch_images_perclass(src, include_exclude_rename)
+        index = cls.read_index(src)
+        return {label: sorted(df.image) for label, df in index.groupby('label')}
+
+    def _load_index(self):
+        if getattr(self, '_shards', None) is None:
+            index = self.read_index(self.src)
+            self._shards = dict(zip(index.image, index.shard))
+            self._members = {shard: dict(zip(df.member, df.image)) for shard, df in index.groupby('shard')}
+
+    def group_of(self, image):
+        self._load_index()
+        return self._shards[image]
+
+    def read_group(self, shard):
+        self._load_index()
+        members = self._members[shard]
+        with tarfile.open(os.path.join(self.src, shard), 'r|') as tar:
+            for member in tar:
+                if member.name not in members: continue
+                img = Image.open(io.BytesIO(tar.extractfile(member).read()))
+                yield members[member.name], img.convert('RGB')
+
+
+class AnnotationDataset(StreamingDataset):
+    """
+    ROIs read straight from raw bins, as labeled by an annotation table. Bins are read one at a time, in full.
+    src is a csv with bin_id, roi_number and label columns. Bins are found under bin_dir, by default the folder of src.
+    Images are identified as "{bin_id}_{roi_number:05d}".
+    """
+    COLUMNS = ['bin_id', 'roi_number', 'label']
+    bin_dir = None
+
+    @classmethod
+    def is_annotation_table(cls, src):
+        if not os.path.isfile(src): return False
+        return set(cls.COLUMNS).issubset(pd.read_csv(src, nrows=0).columns)
+
+    @classmethod
+    def fetch_images_perclass(cls, src, include_exclude_rename=None, dedup=False):
+        assert include_exclude_rename is None, 'annotation tables cannot be combined by a dataset-configuration csv'
+        df = pd.read_csv(src, header=0, usecols=cls.COLUMNS, dtype=dict(bin_id=str, label=str))
+        df['image'] = ['{}_{:05d}'.format(bin_id, int(roi)) for bin_id, roi in zip(df.bin_id, df.roi_number)]
+        return {label: sorted(labeled.image) for label, labeled in df.groupby('label')}
+
+    def subset(self, images_perclass):
+        dataset = super().subset(images_perclass)
+        dataset.bin_dir = self.bin_dir
+        return dataset
+
+    def group_of(self, image):
+        return image.rsplit('_', 1)[0]
+
+    def read_group(self, bin_id):
+        if getattr(self, '_dd', None) is None:
+            self._dd = ifcb.DataDirectory(self.bin_dir or os.path.dirname(os.path.abspath(self.src)))
+            self._rois = {}  # bin_id: annotated roi numbers
+            for image in self.images:
+                bin_of_image, roi_number = image.rsplit('_', 1)
+                self._rois.setdefault(bin_of_image, []).append(int(roi_number))
+        # only annotated ROIs are decoded, images of old-style bins are stitched one at a time
+        with self._dd[bin_id] as bin:
+            bin_images = InfilledImages(bin) if bin.schema == SCHEMA_VERSION_1 else bin.images
+            for roi_number in sorted(self._rois[bin_id]):
+                try: img = bin_images[roi_number]
+                except KeyError: continue  # not in the bin, eg the second half of a stitched pair
+                yield '{}_{:05d}'.format(bin_id, roi_number), IfcbBinDataset.to_pil(img)
+
+
+class FeatureDataset(Dataset):
+    """Precomputed backbone features standing in for the images of a NeustonDataset. See TRAIN --frozen-backbone"""
+
+    def __init__(self, dataset, features, rows):
+        self.dataset = dataset
+        self.features = features  # float16 Tensor of shape (num_images, dim)
+        self.rows = rows          # {image_path: row}
+
+    def __getitem__(self, index):
+        path = self.dataset.images[index]
+        return self.features[self.rows[path]].float(), self.dataset.targets[index], path
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def classes(self): return self.dataset.classes
+    @property
+    def images(self): return self.dataset.images
+    @property
+    def targets(self): return self.dataset.targets
+    @property
+    def count_perclass(self): return self.dataset.count_perclass
+
+
 class ImageFolderWithPaths(datasets.ImageFolder):
     """
     Custom dataset that includes image file paths. Extends torchvision.datasets.ImageFolder
@@ -292,11 +555,16 @@ class ImageFolderWithPaths(datasets.ImageFolder):
 def get_trainval_datasets(args):
     ## initializing data ##
     print('Initializing Data...')
+    if ShardedDataset.is_shard_dir(args.SRC): DatasetClass = ShardedDataset
+    elif AnnotationDataset.is_annotation_table(args.SRC): DatasetClass = AnnotationDataset
+    else: DatasetClass = NeustonDataset
     if not args.class_config:
-        nd = NeustonDataset(src=args.SRC, minimum_images_per_class=args.class_min, maximum_images_per_class=args.class_max)
+        nd = DatasetClass(src=args.SRC, minimum_images_per_class=args.class_min, maximum_images_per_class=args.class_max, dedup=args.dedup)
     else:
-        nd = NeustonDataset.from_csv(src=args.SRC, csv_file=args.class_config[0], column_to_run=args.class_config[1],
-                                     minimum_images_per_class=args.class_min, maximum_images_per_class=args.class_max)
+        nd = DatasetClass.from_csv(src=args.SRC, csv_file=args.class_config[0], column_to_run=args.class_config[1],
+                                     minimum_images_per_class=args.class_min, maximum_images_per_class=args.class_max, dedup=args.dedup)
+    if DatasetClass is AnnotationDataset:
+        nd.bin_dir = args.bin_dir
     # TODO record to args which classes were grouped, skipped, and limited.
     ratio1, ratio2 = map(int, args.split.split(':'))
 
@@ -325,6 +593,9 @@ def get_trainval_datasets(args):
     train_tforms, val_tforms = get_trainval_transforms(args)
     training_dataset.transforms = train_tforms
     validation_dataset.transforms = val_tforms
+    if isinstance(training_dataset, StreamingDataset):
+        training_dataset.shuffle_buffer = args.shuffle_buffer
+        validation_dataset.shuffle = False
 
     return training_dataset, validation_dataset
 
@@ -339,10 +610,11 @@ def parse_imgnorm(img_norm_arg):
     return mean,std
 
 ## transforms and augmentation ##
-def get_trainval_transforms(args):
+def get_trainval_transforms(args, resize=None):
     # Transforms  #
-    args.resize = 299 if args.MODEL == 'inception_v3' else 224
-    tform_resize = transforms.Resize([args.resize,args.resize])
+    # args.resize is MODEL's default input size, see neuston_models.get_model_resize
+    resize = resize or args.resize  # a lower training resolution, see ProgressiveResize
+    tform_resize = transforms.Resize([resize,resize])
     base_tforms = [tform_resize, transforms.ToTensor()]
     if args.img_norm:
         mean,std = parse_imgnorm(args.img_norm)
@@ -382,13 +654,18 @@ class ImageDataset(Dataset):
     adapted from: https://gist.github.com/andrewjong/6b02ff237533b3b2c554701fb53d5c4d
     """
 
-    def __init__(self, image_paths, resize=244, input_src=None):
+    def __init__(self, image_paths, resize, input_src=None, screen_resize=None):
         self.input_src = input_src
         self.image_paths = [img for img in image_paths if img.endswith(datasets.folder.IMG_EXTENSIONS)]
 
-        # use 299x299 for inception_v3, all other models use 244x244
+        # resize is the model's hparams.resize, see TRAIN --resize
         self.transform = transforms.Compose([transforms.Resize([resize, resize]),
                                              transforms.ToTensor()])
+        # RUN --cascade, images are also loaded at the screening model's resize, see CascadeNeustonModel
+        self.screen_transform = None
+        if screen_resize:
+            self.screen_transform = transforms.Compose([transforms.Resize([screen_resize, screen_resize]),
+                                                        transforms.ToTensor()])
 
         if len(self.image_paths) < len(image_paths):
             print('{} non-image files were ommited'.format(len(image_paths)-len(self.image_paths)))
@@ -398,6 +675,8 @@ class ImageDataset(Dataset):
     def __getitem__(self, index):
         path = self.image_paths[index]
         image = datasets.folder.default_loader(path)
+        if self.screen_transform is not None:
+            return self.transform(image), self.screen_transform(image), path
         if self.transform is not None:
             image = self.transform(image)
         return image, path
@@ -410,7 +689,7 @@ class IfcbImageDataset(IterableDataset):
     def __init__(self, data_path, resize):
         self.dd = ifcb.DataDirectory(data_path)
 
-        # use 299x299 for inception_v3, all other models use 244x244
+        # resize is the model's hparams.resize, see TRAIN --resize
         if isinstance(resize, int):
             resize = (resize, resize)
         self.resize = resize
@@ -431,40 +710,240 @@ class IfcbImageDataset(IterableDataset):
 
 
 class IfcbBinDataset(Dataset):
-    def __init__(self, bin, resize, img_norm=None):
-        self.bin = bin
+    def __init__(self, bin, resize, img_norm=None, stitch_cache=None, prefilter=None):
+        self.bin = bin  # bin identity, for all of its ROIs
         self.images = []
-        self.pids = []
+        self.roi_numbers = []
+        self.prefilter = prefilter  # (min_width, min_height, class_label)
+        self.prefiltered = []       # roi numbers of ROIs routed to the prefilter class, never decoded
         self.img_norm = parse_imgnorm(img_norm) if img_norm else None
+        self.screen_resize = None   # RUN --cascade, images are also loaded at the screening model's resize
 
-        # use 299x299 for inception_v3, all other models use 244x244
+        # resize is the model's hparams.resize, see TRAIN --resize
         if isinstance(resize, int):
             resize = (resize, resize)
         self.resize = resize
 
-        # old-style bins need to be stitched and infilled
-        if bin.schema == SCHEMA_VERSION_1:
+        # old-style bins need to be stitched and infilled. Stitched images may be cached, see neuston_cache.StitchCache
+        if bin.schema == SCHEMA_VERSION_1 and stitch_cache is not None:
+            if bin.lid not in stitch_cache:
+                stitch_cache.put(bin.lid, dict(InfilledImages(bin).items()))
+            bin_images = stitch_cache.get(bin.lid)
+        elif bin.schema == SCHEMA_VERSION_1:
             bin_images = InfilledImages(bin)
         else:
             bin_images = bin.images
 
-        for target_number, img in bin_images.items():
-            target_pid = bin.pid.with_target(target_number)
-            self.images.append(img)
-            self.pids.append(target_pid)
+        # ROIs smaller than the prefilter size, as per the ADC, are not decoded
+        tiny = set()
+        if prefilter:
+            min_width, min_height, _ = prefilter
+            widths, heights = bin.adc[bin.schema.ROI_WIDTH], bin.adc[bin.schema.ROI_HEIGHT]
+            tiny = set(int(t) for t in bin.adc.index[(widths < min_width) | (heights < min_height)])
 
-    def __getitem__(self, item):
-        img = self.images[item]
+        for target_number in bin_images.keys():
+            if target_number in tiny:
+                self.prefiltered.append(int(target_number))
+                continue
+            self.images.append(bin_images[target_number])
+            self.roi_numbers.append(int(target_number))
+
+    def with_transforms(self, resize, img_norm=None, screen_resize=None):
+        """A copy of this dataset that shares its already-decoded images but applies a different resize and img_norm.
+           With screen_resize, items are (img, screen_img, roi_number), see CascadeNeustonModel"""
+        dataset = copy.copy(self)
+        dataset.resize = (resize, resize) if isinstance(resize, int) else resize
+        dataset.img_norm = parse_imgnorm(img_norm) if img_norm else None
+        dataset.screen_resize = (screen_resize, screen_resize) if isinstance(screen_resize, int) else screen_resize
+        return dataset
+
+    @staticmethod
+    def to_pil(img):
+        """grayscale bin image array to RGB PIL image"""
         img = transforms.ToPILImage(mode='L')(img)
-        img = img.convert('RGB')
-        img = transforms.Resize(self.resize)(img)
+        return img.convert('RGB')
+
+    def transformed(self, pil_img, resize):
+        img = transforms.Resize(resize)(pil_img)
         img = transforms.ToTensor()(img)
         if self.img_norm:
             img = transforms.Normalize(*self.img_norm)(img)
-        return img, self.pids[item]
+        return img
+
+    def __getitem__(self, item):
+        pil_img = self.to_pil(self.images[item])
+        if self.screen_resize:
+            return self.transformed(pil_img, self.resize), self.transformed(pil_img, self.screen_resize), self.roi_numbers[item]
+        return self.transformed(pil_img, self.resize), self.roi_numbers[item]  # collated into a tensor of roi numbers
 
     def __len__(self):
-        return len(self.pids)
+        return len(self.roi_numbers)
+
+class BinPrefetcher:
+    """
+    Reads upcoming bins in a thread pool, overlapping bin I/O with the classification of the current bin.
+    At most max_bins bins, and max_bytes of raw bin files, are read ahead at any time.
+    If stage_dir is set, raw bin files are first copied there (eg to node-local scratch) and removed once read.
+    Example usage:     prefetcher = BinPrefetcher(((b,None) for b in dd), lambda b,read_b,_: IfcbBinDataset(read_b, 299))
+                       for bin_fileset, payload, dataset_or_exception in prefetcher: ....
+    """
+    BIN_EXTENSIONS = ('.hdr', '.adc', '.roi')
+
+    def __init__(self, items, load_fn, max_bins=2, max_bytes=2**31, stage_dir=None):
+        self.items = items      # iterable of (bin_fileset, payload)
+        self.load_fn = load_fn  # load_fn(bin_fileset, read_bin, payload), where read_bin may be a staged copy
+        self.max_bins = max_bins
+        self.max_bytes = max_bytes
+        self.stage_dir = stage_dir
+        self.io_wait = 0.0    # seconds the consumer spent waiting on bins
+        self.read_time = 0.0  # seconds spent reading bins, summed over threads
+        self._lock = threading.Lock()
+        if stage_dir: os.makedirs(stage_dir, exist_ok=True)
+
+    def bin_nbytes(self, bin_fileset):
+        basepath = bin_fileset.fileset.basepath
+        return sum(os.path.getsize(basepath+ext) for ext in self.BIN_EXTENSIONS if os.path.isfile(basepath+ext))
+
+    def _load(self, bin_fileset, payload):
+        t0 = time.time()
+        read_bin, staged = bin_fileset, []
+        try:
+            if self.stage_dir:
+                basepath = bin_fileset.fileset.basepath
+                staged_basepath = os.path.join(self.stage_dir, os.path.basename(basepath))
+                for ext in self.BIN_EXTENSIONS:
+                    shutil.copyfile(basepath+ext, staged_basepath+ext)
+                    staged.append(staged_basepath+ext)
+                read_bin = FilesetBin(Fileset(staged_basepath))
+            return self.load_fn(bin_fileset, read_bin, payload)
+        finally:
+            for path in staged:
+                if os.path.isfile(path): os.remove(path)
+            with self._lock:
+                self.read_time += time.time()-t0
+
+    def __iter__(self):
+        if not self.max_bins:  # no read-ahead
+            for bin_fileset, payload in self.items:
+                t0 = time.time()
+                try: loaded = self._load(bin_fileset, payload)
+                except Exception as e: loaded = e
+                self.io_wait += time.time()-t0
+                yield bin_fileset, payload, loaded
+            return
+
+        items = iter(self.items)
+        queue = deque()  # (bin_fileset, payload, nbytes, future)
+        queued_bytes = 0
+        next_item = next(items, None)
+        with ThreadPoolExecutor(self.max_bins) as pool:
+            while queue or next_item is not None:
+                # fill the read-ahead window. The next bin is always read, even if it alone exceeds max_bytes
+                while next_item is not None and len(queue) < self.max_bins:
+                    bin_fileset, payload = next_item
+                    nbytes = self.bin_nbytes(bin_fileset)
+                    if queue and queued_bytes+nbytes > self.max_bytes: break
+                    queue.append((bin_fileset, payload, nbytes, pool.submit(self._load, bin_fileset, payload)))
+                    queued_bytes += nbytes
+                    next_item = next(items, None)
+
+                bin_fileset, payload, nbytes, future = queue.popleft()
+                t0 = time.time()
+                try: loaded = future.result()
+                except Exception as e: loaded = e
+                self.io_wait += time.time()-t0
+                queued_bytes -= nbytes
+                yield bin_fileset, payload, loaded
+
+
+class BinWatcher:
+    """
+    Polls a data directory for newly completed bins, for RUN --watch.
+    Directories are stat'ed every poll, but only listed again when their mtime changes.
+    A bin is complete once its .hdr, .adc and .roi files all exist and none was modified in the last settle seconds.
+    Completed bins are yielded once each, until interrupted (ctrl-c).
+    Latency, from bin completion to classification, is logged to metrics_file as bins are classified.
+    Bins completed before the watcher started are a backlog; they are classified but their latency is not logged.
+    Every yielded bin must be passed to done(), whether or not its results were written.
+    Example usage:     watcher = BinWatcher('path/to/data', interval=60, settle=30)
+                       for bin_fileset in watcher: ....; watcher.done(bin_fileset, classified=True)
+    """
+    BIN_EXTENSIONS = ('.hdr', '.adc', '.roi')
+
+    def __init__(self, root, interval=60, settle=30, metrics_file=None):
+        self.root = root
+        self.interval = interval
+        self.settle = settle
+        self.metrics_file = metrics_file
+        self.started = time.time()
+        self.dir_mtimes = {}   # directory: mtime when last listed
+        self.subdirs = {}      # directory: subdirectories
+        self.incomplete = set()  # basepaths of bins seen but not yet complete
+        self.yielded = set()   # basepaths
+        self.detected = {}     # basepath: (completion time, detection time)
+        self.latencies = []
+
+    def _scan_dir(self, dirpath):
+        """lists dirpath if it changed, recursing into subdirectories. Returns bin basepaths found"""
+        try: mtime = os.stat(dirpath).st_mtime
+        except FileNotFoundError: return []
+        subdirs = self.subdirs.setdefault(dirpath, set())
+        basepaths = []
+        if self.dir_mtimes.get(dirpath) != mtime:
+            self.dir_mtimes[dirpath] = mtime
+            for entry in os.scandir(dirpath):
+                if entry.is_dir():
+                    subdirs.add(entry.path)
+                elif entry.name.endswith(self.BIN_EXTENSIONS):
+                    basepaths.append(os.path.splitext(entry.path)[0])
+        for subdir in sorted(subdirs):
+            basepaths.extend(self._scan_dir(subdir))
+        return basepaths
+
+    def _is_complete(self, basepath, now):
+        try: mtimes = [os.stat(basepath+ext).st_mtime for ext in self.BIN_EXTENSIONS]
+        except FileNotFoundError: return None
+        return max(mtimes) if max(mtimes) <= now-self.settle else None
+
+    def poll(self):
+        """returns FilesetBins completed since the last poll"""
+        now = time.time()
+        for basepath in self._scan_dir(self.root):
+            if basepath not in self.yielded:
+                self.incomplete.add(basepath)
+        completed = []
+        for basepath in sorted(self.incomplete):
+            completion_time = self._is_complete(basepath, now)
+            if completion_time is None: continue
+            self.incomplete.remove(basepath)
+            self.yielded.add(basepath)
+            self.detected[basepath] = (completion_time, now)
+            completed.append(FilesetBin(Fileset(basepath)))
+        return completed
+
+    def __iter__(self):
+        try:
+            while True:
+                t0 = time.time()
+                yield from self.poll()
+                time.sleep(max(0, self.interval-(time.time()-t0)))
+        except KeyboardInterrupt:
+            print('Watch stopped')
+
+    def done(self, bin_fileset, classified):
+        """forgets a bin yielded by this watcher, recording its latency if its results were written"""
+        completion_time, detection_time = self.detected.pop(bin_fileset.fileset.basepath)
+        if not classified or completion_time < self.started: return
+        now = time.time()
+        latency = now-completion_time
+        self.latencies.append(latency)
+        print('{} classified, {:.1f}s after completion ({:.1f}s after detection). Median latency: {:.1f}s over {} bins'.format(
+              bin_fileset.lid, latency, now-detection_time, sorted(self.latencies)[len(self.latencies)//2], len(self.latencies)), flush=True)
+        if self.metrics_file:
+            new_file = not os.path.isfile(self.metrics_file)
+            with open(self.metrics_file, 'a') as f:
+                if new_file: f.write('bin_id,completed,detected,classified,latency\n')
+                f.write('{},{:.3f},{:.3f},{:.3f},{:.3f}\n'.format(bin_fileset.lid, completion_time, detection_time, now, latency))
 
 def get_run_dataset():
     pass
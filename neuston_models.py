@@ -2,12 +2,22 @@
 
 # built in imports
 import argparse
+import os
+import math
+import time
+import json
+import hashlib
+from functools import reduce
 
 # 3rd party imports
 import torch
 import torch.nn as nn
-from torch.optim import Adam
-from torch.nn.functional import softmax
+from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+from torch.optim import Adam, AdamW, SGD
+from torch.optim.lr_scheduler import OneCycleLR, LambdaLR, ReduceLROnPlateau
+from torch.nn.functional import softmax, log_softmax, kl_div, adaptive_avg_pool2d
+import torchvision
 import torchvision.models as MODEL_MODULE
 from torchvision.models.inception import InceptionOutputs
 import pytorch_lightning as ptl
@@ -19,6 +29,10 @@ import ifcb
 from neuston_data import IfcbBinDataset
 
 
+# model families newer than the pinned torchvision 0.8.2, and the torchvision version that introduced them
+TORCHVISION_REQUIRED = {'mobilenet_v3': '0.9', 'efficientnet': '0.11', 'regnet': '0.11', 'convnext': '0.12'}
+
+
 def get_namebrand_model(model_name, num_o_classes, pretrained=False):
     if model_name == 'inception_v3':
         model = MODEL_MODULE.inception_v3(pretrained)  #, num_classes=num_o_classes, aux_logits=False)
@@ -40,11 +54,109 @@ def get_namebrand_model(model_name, num_o_classes, pretrained=False):
     elif model_name.startswith('densenet'):
         model = getattr(MODEL_MODULE, model_name)(pretrained)
         model.classifier = nn.Linear(model.classifier.in_features, num_o_classes)
+    elif model_name.startswith(('mobilenet_v3', 'efficientnet', 'regnet', 'convnext')):
+        if not hasattr(MODEL_MODULE, model_name):
+            required = next(version for prefix,version in TORCHVISION_REQUIRED.items() if model_name.startswith(prefix))
+            raise KeyError('model "{}" requires torchvision>={}, installed is torchvision {}'.format(model_name, required, torchvision.__version__))
+        model = getattr(MODEL_MODULE, model_name)(pretrained)
+        if model_name.startswith('regnet'):
+            model.fc = nn.Linear(model.fc.in_features, num_o_classes)
+        else:  # the head is the last layer of the classifier block
+            model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_o_classes)
     else:
         raise KeyError("model unknown!")
     return model
 
 
+# input resolution each model family was pretrained at, by longest matching model name prefix
+MODEL_RESIZE = {'inception_v3': 299,
+                'efficientnet_b0': 224, 'efficientnet_b1': 240, 'efficientnet_b2': 260, 'efficientnet_b3': 300,
+                'efficientnet_b4': 380, 'efficientnet_b5': 456, 'efficientnet_b6': 528, 'efficientnet_b7': 600}
+
+
+def get_model_resize(model_name, default=224):
+    """Default input image size of a get_namebrand_model model"""
+    prefixes = [prefix for prefix in MODEL_RESIZE if model_name.startswith(prefix)]
+    return MODEL_RESIZE[max(prefixes, key=len)] if prefixes else default
+
+
+def _torchvision_classes(*names):
+    """the model classes of names that the installed torchvision has. MobileNetV3, EfficientNet, RegNet and ConvNeXt are newer additions"""
+    return tuple(getattr(MODEL_MODULE, name) for name in names if hasattr(MODEL_MODULE, name))
+
+
+def get_namebrand_head(model):
+    """The final classifying layer of a get_namebrand_model model. Its inputs are the model's penultimate-layer features"""
+    if isinstance(model, (MODEL_MODULE.Inception3, MODEL_MODULE.ResNet) + _torchvision_classes('RegNet')):
+        return model.fc
+    elif isinstance(model, _torchvision_classes('MobileNetV3', 'EfficientNet', 'ConvNeXt')):
+        return model.classifier[-1]
+    elif isinstance(model, (MODEL_MODULE.AlexNet, MODEL_MODULE.VGG)):
+        return model.classifier[6]
+    elif isinstance(model, MODEL_MODULE.SqueezeNet):
+        return model.classifier[1]
+    elif isinstance(model, MODEL_MODULE.DenseNet):
+        return model.classifier
+    else:
+        raise KeyError("model unknown!")
+
+
+def get_layer_groups(model):
+    """(name, module) layer groups of a get_namebrand_model model that have parameters, ordered from input to head.
+       Sequential feature blocks are split into their layers. The classifying head itself is not a layer group."""
+    head = get_namebrand_head(model)
+    head_params = set(id(param) for param in head.parameters())
+    groups = []
+    for name,child in model.named_children():
+        if isinstance(child, nn.Sequential) and not any(module is head for module in child.modules()):
+            groups.extend(('{}.{}'.format(name,subname), subchild) for subname,subchild in child.named_children())
+        else:
+            groups.append((name,child))
+    return [(name,group) for name,group in groups if any(id(param) not in head_params for param in group.parameters())]
+
+
+def model_stats(model, resize, batch_size=8, repeats=3):
+    """Parameter count, GFLOPs per image (2x the multiply-accumulates of conv and linear layers), and CPU eval latency in ms per image.
+       Random inputs are drawn from a forked RNG, so seeded runs are unaffected"""
+    with torch.random.fork_rng(devices=[]):
+        return _model_stats(model, resize, batch_size, repeats)
+
+
+def _model_stats(model, resize, batch_size, repeats):
+    macs = []
+    def count_macs(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            macs.append(output[0].numel() * module.in_channels//module.groups * module.kernel_size[0]*module.kernel_size[1])
+        elif isinstance(module, nn.Linear):
+            macs.append(module.in_features * module.out_features)
+    hooks = [module.register_forward_hook(count_macs) for module in model.modules() if isinstance(module, (nn.Conv2d, nn.Linear))]
+
+    was_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        model(torch.randn(1, 3, resize, resize, device=device))
+        for hook in hooks: hook.remove()
+        model.cpu()
+        batch = torch.randn(batch_size, 3, resize, resize)
+        model(batch)  # warmup
+        start = time.time()
+        for _ in range(repeats):
+            model(batch)
+        latency = (time.time()-start)/repeats/batch_size
+    model.to(device)
+    model.train(was_training)
+    return dict(params=sum(p.numel() for p in model.parameters()), gflops=2*sum(macs)/1e9, latency_ms=1000*latency)
+
+
+def format_model_stats(rows):
+    """rows of (model_name, resize, model_stats) as a printable table"""
+    lines = ['{:<20} {:>6} {:>10} {:>8} {:>12}'.format('MODEL', 'RESIZE', 'PARAMS', 'GFLOPS', 'CPU ms/img')]
+    for model_name, resize, stats in rows:
+        lines.append('{:<20} {:>6} {:>9.1f}M {:>8.2f} {:>12.1f}'.format(model_name, resize, stats['params']/1e6, stats['gflops'], stats['latency_ms']))
+    return '\n'.join(lines)
+
+
 class NeustonModel(ptl.LightningModule):
     def __init__(self, hparams):
         super().__init__()
@@ -59,14 +171,113 @@ class NeustonModel(ptl.LightningModule):
         self.best_val_loss = np.inf
         self.best_epoch = 0
         self.agg_train_loss = 0.0
+        self.extract_features = False  # RUN --features
+        self.head_only = False  # TRAIN --frozen-backbone, inputs are precomputed features
+        self.full_validation_loader = None  # TRAIN --val-subset, the whole validation set
+        self.validated_dataset = None  # dataset of the latest validation results
+        self.teacher_logits = None  # TRAIN --teacher, (logits, {image_path: row}) of cached teacher logits for training images
 
     def configure_optimizers(self):
-        return Adam(self.parameters(), lr=0.001)
+        # models trained before --optimizer and --scheduler existed used Adam(lr=0.001) without a schedule
+        lr = getattr(self.hparams, 'learning_rate', 0.001)
+        weight_decay = getattr(self.hparams, 'weight_decay', 0)
+        optimizer_name = getattr(self.hparams, 'optimizer', 'Adam')
+        if optimizer_name == 'SGD':
+            optimizer = SGD(self.parameters(), lr=lr, momentum=self.hparams.momentum, nesterov=True, weight_decay=weight_decay)
+        elif optimizer_name == 'AdamW':
+            optimizer = AdamW(self.parameters(), lr=lr, weight_decay=weight_decay)
+        else:
+            optimizer = Adam(self.parameters(), lr=lr, weight_decay=weight_decay)
+
+        scheduler_name = getattr(self.hparams, 'scheduler', None)
+        if not scheduler_name:
+            return optimizer
+        if scheduler_name == 'plateau':
+            # patience is counted in validations, like EarlyStopping's
+            val_every = getattr(self.hparams, 'val_every', 1)
+            scheduler = dict(scheduler=ReduceLROnPlateau(optimizer, factor=self.hparams.lr_factor, patience=max(1, self.hparams.lr_patience//val_every)),
+                             monitor='val_loss', interval='epoch', frequency=val_every, strict=False)
+            return dict(optimizer=optimizer, lr_scheduler=scheduler)
+
+        # step-wise schedules over the whole training, with a linear warmup of --warmup epochs
+        # optimizer steps of each process, whose loader is sharded by world_size. Rounded up, as OneCycleLR fails if stepped past total_steps
+        loader = self.train_dataloader()
+        batches_per_process = math.ceil(math.ceil(len(loader.dataset)/self.trainer.world_size)/loader.batch_size)
+        steps_per_epoch = math.ceil(batches_per_process/self.trainer.accumulate_grad_batches)
+        total_steps = steps_per_epoch*self.trainer.max_epochs
+        warmup_steps = max(1, int(self.hparams.warmup*steps_per_epoch))
+        if scheduler_name == 'onecycle':
+            scheduler = OneCycleLR(optimizer, max_lr=lr, total_steps=total_steps, pct_start=min(0.5, warmup_steps/total_steps))
+        else:  # cosine
+            def warmup_cosine(step):
+                if step < warmup_steps:
+                    return (step+1)/warmup_steps
+                progress = min(1.0, (step-warmup_steps)/max(1, total_steps-warmup_steps))
+                return 0.5*(1+math.cos(math.pi*progress))
+            scheduler = LambdaLR(optimizer, warmup_cosine)
+        return dict(optimizer=optimizer, lr_scheduler=dict(scheduler=scheduler, interval='step'))
 
     def forward(self, inputs):
+        if self.head_only:
+            return get_namebrand_head(self.model)(inputs)
         outputs = self.model(inputs)
         return outputs
 
+    def freeze_backbone(self):
+        """Only the classifying head is trained, forward() expects precomputed backbone features"""
+        for param in self.model.parameters():
+            param.requires_grad = False
+        for param in get_namebrand_head(self.model).parameters():
+            param.requires_grad = True
+        self.head_only = True
+
+    def features(self, inputs):
+        """Returns the penultimate-layer features (ie the inputs of the classifying head) and the outputs of a forward pass"""
+        captured = []
+        hook = get_namebrand_head(self.model).register_forward_hook(lambda module,module_inputs,module_outputs: captured.append(module_inputs[0]))
+        try:
+            outputs = self.forward(inputs)
+        finally:
+            hook.remove()
+        features = captured[0]
+        if features.dim() == 4:  # squeezenet's head is a conv layer
+            features = adaptive_avg_pool2d(features, 1)
+        return torch.flatten(features, 1), outputs
+
+    def layer_groups(self):
+        return get_layer_groups(self.model)
+
+    def freeze_layer_groups(self, n):
+        """Freezes the first n layer groups and unfreezes the rest. The classifying head is always trainable"""
+        for idx,(name,group) in enumerate(self.layer_groups()):
+            for param in group.parameters():
+                param.requires_grad = idx >= n
+        for param in get_namebrand_head(self.model).parameters():
+            param.requires_grad = True
+
+    def transfer_weights(self, parent):
+        """Warm start from a previously trained NeustonModel of the same architecture.
+           Classifying-head rows of classes shared with parent keep their weights. Returns the shared classes."""
+        heads = [get_namebrand_head(self.model)]
+        if isinstance(self.model, MODEL_MODULE.Inception3) and self.model.AuxLogits is not None:
+            heads.append(self.model.AuxLogits.fc)
+        head_params = ['{}.{}'.format(name,param) for name,module in self.model.named_modules()
+                       for param,_ in module.named_parameters(recurse=False) if any(module is head for head in heads)]
+
+        shared_classes = [c for c in self.hparams.classes if c in parent.hparams.classes]
+        new_idxs = [self.hparams.classes.index(c) for c in shared_classes]
+        parent_idxs = [parent.hparams.classes.index(c) for c in shared_classes]
+
+        state_dict = self.model.state_dict()
+        parent_state_dict = parent.model.state_dict()
+        for key,value in parent_state_dict.items():
+            if key in head_params:
+                state_dict[key][new_idxs] = value[parent_idxs]  # class is the first dimension of head weights and biases
+            else:
+                state_dict[key] = value
+        self.model.load_state_dict(state_dict)
+        return shared_classes
+
     def loss(self, inputs, outputs):
         if isinstance(outputs,tuple) and len(outputs)==2: # inception_v3
             outputs, aux_outputs = outputs
@@ -77,11 +288,25 @@ class NeustonModel(ptl.LightningModule):
             batch_loss = self.criterion(outputs, inputs)
         return batch_loss
 
+    def distillation_loss(self, inputs, outputs, input_srcs):
+        """--distill-alpha weighted sum of the soft-target loss against cached teacher logits and the hard-label loss"""
+        logits, rows = self.teacher_logits
+        teacher_outputs = logits[[rows[src] for src in input_srcs]].to(self.device).float()
+        student_outputs = outputs[0] if isinstance(outputs,tuple) and len(outputs)==2 else outputs  # inception_v3
+        T = self.hparams.distill_temperature
+        # scaled by T^2 so that soft-target gradients keep their magnitude across temperatures
+        soft_loss = kl_div(log_softmax(student_outputs/T, dim=1), softmax(teacher_outputs/T, dim=1), reduction='batchmean')*T*T
+        alpha = self.hparams.distill_alpha
+        return alpha*soft_loss + (1-alpha)*self.loss(inputs, outputs)
+
     # TRAINING #
     def training_step(self, batch, batch_nb):
         input_data, input_classes, input_src =  batch
         outputs = self.forward(input_data)
-        batch_loss = self.loss(input_classes, outputs)
+        if self.teacher_logits is not None:
+            batch_loss = self.distillation_loss(input_classes, outputs, input_src)
+        else:
+            batch_loss = self.loss(input_classes, outputs)
         self.agg_train_loss += batch_loss.item()
         return dict(loss=batch_loss)
 
@@ -103,10 +328,14 @@ class NeustonModel(ptl.LightningModule):
                     val_input_srcs=input_src)
 
     def validation_epoch_end(self, steps):
-        print(end='\n\n') # give space for progress bar
+        if self.trainer.is_global_zero: print(end='\n\n') # give space for progress bar
         if self.current_epoch==0: self.best_val_loss = np.inf  # takes care of any lingering val_loss from sanity checks
 
-        validation_loss = torch.stack([batch['val_batch_loss'] for batch in steps]).sum()
+        validation_loss, outputs, input_classes, input_srcs = self.collate_validation_steps(steps)
+        self.validated_dataset = self.val_dataloader().dataset
+        train_loss = self.agg_train_loss
+        if self.trainer.world_size > 1:
+            train_loss = self.all_gather(torch.tensor(train_loss, device=self.device)).sum().item()
         #eoe0 = 'validation_epoch_end: best_val_loss={}, curr_val_loss={}, curr<best={}, curr-best (neg is good)={}'
         #eoe0 = eoe0.format(self.best_val_loss, validation_loss.item(), validation_loss.item()<self.best_val_loss, validation_loss.item()-self.best_val_loss)
         #print(eoe0)
@@ -115,22 +344,28 @@ class NeustonModel(ptl.LightningModule):
             self.best_val_loss = validation_loss.item()
             self.best_epoch = self.current_epoch
 
-        outputs = torch.cat([batch['val_outputs'] for batch in steps],dim=0).detach().cpu().numpy()
+            # val_loss stays that of the validation subset, so that it is comparable across epochs
+            if self.full_validation_loader is not None:
+                full_validation_loss, outputs, input_classes, input_srcs = self.full_validation()
+                self.validated_dataset = self.full_validation_loader.dataset
+                self.log('full_val_loss', full_validation_loss, on_epoch=True)
+                if self.trainer.is_global_zero: print('Validation subset improved, full validation loss: {:.3f}'.format(full_validation_loss))
+
+        outputs = outputs.detach().cpu().numpy()
         output_classes = np.argmax(outputs, axis=1)
-        input_classes = torch.cat([batch['val_input_classes'] for batch in steps],dim=0).detach().cpu().numpy()
-        input_srcs = [item for sublist in [batch['val_input_srcs'] for batch in steps] for item in sublist]
+        input_classes = input_classes.detach().cpu().numpy()
 
         f1_weighted = metrics.f1_score(input_classes, output_classes, average='weighted')
         f1_macro = metrics.f1_score(input_classes, output_classes, average='macro')
 
         eoe = 'Best Epoch: {}, train_loss: {:.3f}, val_loss: {:.3f}, val_f1_w={:02.1f}%, val_f1_m={:02.1f}%'
-        eoe = eoe.format(True if self.current_epoch==self.best_epoch else self.best_epoch+1, self.agg_train_loss, validation_loss, 100*f1_weighted, 100*f1_macro)
-        print(eoe, flush=True, end='\n\n')  # so slurm output can be followed along
+        eoe = eoe.format(True if self.current_epoch==self.best_epoch else self.best_epoch+1, train_loss, validation_loss, 100*f1_weighted, 100*f1_macro)
+        if self.trainer.is_global_zero: print(eoe, flush=True, end='\n\n')  # so slurm output can be followed along
 
         # used by callbacks and logger
         self.log('epoch', self.current_epoch, on_epoch=True)
         self.log('best', self.best_epoch==self.current_epoch, on_epoch=True)
-        self.log('train_loss', self.agg_train_loss, on_epoch=True)
+        self.log('train_loss', train_loss, on_epoch=True)
         self.log('val_loss', validation_loss, on_epoch=True)
 
         # csv_logger logger hacked to not include these in epochs.csv output
@@ -143,48 +378,273 @@ class NeustonModel(ptl.LightningModule):
         self.log('f1_macro',f1_macro, on_epoch=True)
         self.log('f1_weighted',f1_weighted, on_epoch=True)
 
-        # Cleanup
+        return dict(hiddens=dict(outputs=outputs))
+
+    def full_validation(self):
+        """Runs validation steps over the whole of full_validation_loader. See TRAIN --val-subset"""
+        loader = self.full_validation_loader
+        if self.trainer.world_size > 1 and not isinstance(loader.dataset, IterableDataset):
+            sampler = DistributedSampler(loader.dataset, num_replicas=self.trainer.world_size, rank=self.global_rank, shuffle=False)
+            loader = DataLoader(loader.dataset, batch_size=loader.batch_size, num_workers=loader.num_workers, sampler=sampler)
+        steps = []
+        with torch.no_grad():
+            for batch_idx,(input_data, input_classes, input_srcs) in enumerate(loader):
+                batch = input_data.to(self.device), input_classes.to(self.device), input_srcs
+                steps.append(self.validation_step(batch, batch_idx))
+        return self.collate_validation_steps(steps, loader.dataset.images)
+
+    def collate_validation_steps(self, steps, val_images=None):
+        """Returns validation_loss, outputs, input_classes, input_srcs of all validation steps.
+           When training is distributed, results of all processes are gathered and de-duplicated,
+           since DistributedSampler pads each process to an equal number of images."""
+        validation_loss = torch.stack([batch['val_batch_loss'] for batch in steps]).sum()
+        outputs = torch.cat([batch['val_outputs'] for batch in steps],dim=0)
+        input_classes = torch.cat([batch['val_input_classes'] for batch in steps],dim=0)
+        input_srcs = [item for sublist in [batch['val_input_srcs'] for batch in steps] for item in sublist]
+        if self.trainer.world_size == 1:
+            return validation_loss, outputs, input_classes, input_srcs
+
+        # strings cannot be gathered, so input_srcs are gathered as their dataset indices
+        if val_images is None: val_images = self.val_dataloader().dataset.images
+        image_idxs = getattr(self, '_val_image_idxs', {})
+        if id(val_images) not in image_idxs:
+            image_idxs[id(val_images)] = {img:idx for idx,img in enumerate(val_images)}
+            self._val_image_idxs = image_idxs
+        image_idxs = torch.tensor([image_idxs[id(val_images)][src] for src in input_srcs], device=outputs.device)
+
+        validation_loss = self.all_gather(validation_loss).sum()
+        outputs = self.all_gather(outputs).flatten(0,1)
+        input_classes = self.all_gather(input_classes).flatten(0,1)
+        image_idxs = self.all_gather(image_idxs).flatten(0,1).cpu().numpy()
+        image_idxs, unique = np.unique(image_idxs, return_index=True)
+        unique = torch.as_tensor(unique, device=outputs.device)
+        return validation_loss, outputs[unique], input_classes[unique], [val_images[idx] for idx in image_idxs]
+
+    def on_train_epoch_start(self):
+        # train_loss is that of the latest epoch, also when validating less often, see TRAIN --val-every
         self.agg_train_loss = 0.0
 
-        return dict(hiddens=dict(outputs=outputs))
+    def on_train_start(self):
+        # distributed cpu processes share the node's cores
+        ddp_cpu = getattr(self.hparams, 'ddp_cpu', None)
+        if ddp_cpu:
+            torch.set_num_threads(max(1, os.cpu_count()//ddp_cpu))
 
     # RUNNING the model #
     def test_step(self, batch, batch_idx, dataloader_idx=None):
         input_data, input_srcs = batch
-        outputs = self.forward(input_data)
+        if self.extract_features:
+            features, outputs = self.features(input_data)
+        else:
+            outputs = self.forward(input_data)
         outputs = outputs.logits if isinstance(outputs,InceptionOutputs) else outputs
         outputs = softmax(outputs, dim=1)
-        return dict(test_outputs=outputs, test_srcs=input_srcs)
+        step = dict(test_outputs=outputs, test_srcs=input_srcs)
+        if self.extract_features: step['test_features'] = features.half()
+        return step
 
     def test_epoch_end(self, steps):
+        RRs = self.collate_run_results(steps, test_datasets(self))
+        self.log('RunResults',RRs)
+        #return dict(RunResults=RRs)
 
+    def collate_run_results(self, steps, datasets):
         # handle single and multiple test dataloaders
-        datasets = self.test_dataloader()
-        if isinstance(datasets, list): datasets = [ds.dataset for ds in datasets]
-        else: datasets = [datasets.dataset]
         if isinstance(steps[0],dict):
             steps = [steps]
 
         RRs = []
         for steps,dataset in zip(steps,datasets):
             outputs = torch.cat([batch['test_outputs'] for batch in steps],dim=0).detach().cpu().numpy()
-            images = [batch['test_srcs'] for batch in steps]
-            images = [item for sublist in images for item in sublist]  # flatten list
             if isinstance(dataset, IfcbBinDataset):
                 input_obj = dataset.bin.pid
+                images = torch.cat([batch['test_srcs'] for batch in steps]).cpu().numpy().astype('u4')  # roi numbers
             else:
                 input_obj = dataset.input_src  # a path string
-            rr = self.RunResults(inputs=images, outputs=outputs, input_obj=input_obj)
+                images = [batch['test_srcs'] for batch in steps]
+                images = [item for sublist in images for item in sublist]  # flatten list
+            rr = self.RunResults(inputs=images, outputs=outputs, input_obj=input_obj,
+                                 model_id=self.hparams.model_id, class_labels=self.hparams.classes)
+            if 'test_features' in steps[0]:
+                rr.features = torch.cat([batch['test_features'] for batch in steps],dim=0).detach().cpu().numpy()
+            if isinstance(dataset, IfcbBinDataset) and dataset.prefilter:
+                add_prefiltered(rr, dataset)
             RRs.append(rr)
-        self.log('RunResults',RRs)
-        #return dict(RunResults=RRs)
+        return RRs
 
     class RunResults:
-        def __init__(self, inputs, outputs, input_obj):
-            self.inputs = inputs
+        def __init__(self, inputs, outputs, input_obj, model_id=None, class_labels=None):
+            self.inputs = inputs  # roi numbers array for bins, image paths otherwise
             self.outputs = outputs
             self.input_obj = input_obj
+            self.model_id = model_id
+            self.class_labels = class_labels
+            self.features = None
+            self.output_stages = None  # cascade stage that scored each input, see CascadeNeustonModel
+            self.prefiltered = None    # mask of inputs assigned by RUN --prefilter rather than scored, see add_prefiltered
+            self.prefilter = None
             self.type = 'Bin' if isinstance(input_obj,ifcb.Pid) else 'ImgDir'
         def __repr__(self):
             rep = '{}: {} ({} imgs)'.format(self.type, self.input_obj, len(self.inputs))
             return repr(rep)
+
+
+class MultiNeustonModel(ptl.LightningModule):
+    """Runs several NeustonModels over the same test batches, such that images are only loaded and transformed once.
+       The models must share the same resize and img_norm hparams"""
+    def __init__(self, classifiers):
+        super().__init__()
+        self.classifiers = nn.ModuleList(classifiers)
+
+    def test_step(self, batch, batch_idx, dataloader_idx=None):
+        return [classifier.test_step(batch, batch_idx, dataloader_idx) for classifier in self.classifiers]
+
+    def test_epoch_end(self, steps):
+        # steps are per-batch lists of per-classifier outputs, or lists thereof for multiple test dataloaders
+        if isinstance(steps[0][0],dict):
+            steps = [steps]
+        datasets = test_datasets(self)
+
+        RRs = []
+        for idx,classifier in enumerate(self.classifiers):
+            classifier_steps = [[batch[idx] for batch in dataloader_steps] for dataloader_steps in steps]
+            RRs.extend(classifier.collate_run_results(classifier_steps, datasets))
+        self.log('RunResults',RRs)
+
+
+class CascadeNeustonModel(ptl.LightningModule):
+    """Scores every image with a small, fast screening model. Only images whose screening score is below threshold,
+       or whose screening class is one of hard_classes, are re-scored by the full model.
+       Batches are (full_inputs, screen_inputs, srcs), images loaded at both models' resize, see IfcbBinDataset.with_transforms.
+       Run results are those of the full model, with output_stages of 0 (screen) or 1 (full) for each image,
+       or PREFILTERED_STAGE for ROIs that RUN --prefilter assigned without scoring.
+       If report is set, the full model also scores every image, and agreement with it is tallied in report_rows."""
+    PREFILTERED_STAGE = 255
+
+    def __init__(self, screen, full, threshold, hard_classes=(), report=False):
+        super().__init__()
+        assert screen.hparams.classes == full.hparams.classes, 'cascade models must have identical classes'
+        assert str(screen.hparams.img_norm) == str(full.hparams.img_norm), 'cascade models must have the same img_norm'
+        self.screen = screen
+        self.full = full
+        self.threshold = threshold
+        unknown = set(hard_classes)-set(full.hparams.classes)
+        assert not unknown, 'hard classes not in model classes: {}'.format(sorted(unknown))
+        self.register_buffer('hard_mask', torch.tensor([c in hard_classes for c in full.hparams.classes]))
+        self.report = report
+        self.report_rows = []  # input_obj, inputs, escalated, cascade_agree, screen_agree
+
+    def test_step(self, batch, batch_idx, dataloader_idx=None):
+        input_data, screen_data, input_srcs = batch
+        screen_outputs = self.screen.test_step((screen_data, input_srcs), batch_idx)['test_outputs']
+        confidence, screen_classes = screen_outputs.max(dim=1)
+        escalate = (confidence < self.threshold) | self.hard_mask[screen_classes]
+
+        outputs = screen_outputs.clone()
+        if self.report:
+            full_outputs = self.full.test_step((input_data, input_srcs), batch_idx)['test_outputs']
+            outputs[escalate] = full_outputs[escalate]
+        elif escalate.any():
+            idxs = escalate.nonzero().flatten()
+            escalated_srcs = input_srcs[idxs] if torch.is_tensor(input_srcs) else [input_srcs[i] for i in idxs]
+            outputs[idxs] = self.full.test_step((input_data[idxs], escalated_srcs), batch_idx)['test_outputs']
+
+        step = dict(test_outputs=outputs, test_srcs=input_srcs, test_stages=escalate.to(torch.uint8))
+        if self.report:
+            full_classes = full_outputs.argmax(dim=1)
+            step['test_agree'] = torch.stack([outputs.argmax(dim=1)==full_classes, screen_classes==full_classes])
+        return step
+
+    def test_epoch_end(self, steps):
+        if isinstance(steps[0],dict):
+            steps = [steps]
+        RRs = self.full.collate_run_results(steps, test_datasets(self))
+        for rr,dataloader_steps in zip(RRs,steps):
+            output_stages = torch.cat([batch['test_stages'] for batch in dataloader_steps]).cpu().numpy()
+            rr.output_stages = np.pad(output_stages, (0, len(rr.inputs)-len(output_stages)), constant_values=self.PREFILTERED_STAGE)  # prefiltered inputs, if any, were not scored
+            if self.report:
+                agree = torch.cat([batch['test_agree'] for batch in dataloader_steps],dim=1).sum(dim=1).tolist()
+                self.report_rows.append([rr.input_obj, len(output_stages), int(output_stages.sum())]+agree)  # scored images only
+        self.log('RunResults',RRs)
+
+
+def add_prefiltered(rr, dataset):
+    """Appends the ROIs that an IfcbBinDataset prefiltered by size to RunResults rr.
+       They are given a score of 1 for the prefilter class, and are marked in rr.prefiltered"""
+    min_width, min_height, class_label = dataset.prefilter
+    scores = np.zeros((len(dataset.prefiltered), len(rr.class_labels)), dtype=rr.outputs.dtype)
+    scores[:, rr.class_labels.index(class_label)] = 1
+    rr.prefiltered = np.concatenate([np.zeros(len(rr.inputs), dtype=bool), np.ones(len(scores), dtype=bool)])
+    rr.prefilter = dict(min_width=min_width, min_height=min_height, class_label=class_label)
+    rr.inputs = np.concatenate([rr.inputs, np.asarray(dataset.prefiltered, dtype='u4')])
+    rr.outputs = np.concatenate([rr.outputs, scores])
+    return rr
+
+
+## Slim inference models ##
+# MODEL_ID.slim.json: hparams and an index of tensors in MODEL_ID.slim.weights
+# MODEL_ID.slim.weights: raw tensor data, 64-byte aligned, memory-mapped when loaded
+
+def save_slim(classifier, header_path):
+    """Writes an inference-only version of a NeustonModel, without optimizer and callback states"""
+    assert header_path.endswith('.slim.json'), 'slim model files must end with ".slim.json"'
+    weights_path = header_path.replace('.slim.json', '.slim.weights')
+    tensors = {}
+    offset = 0
+    sha1 = hashlib.sha1()
+    with open(weights_path, 'wb') as f:
+        for name,tensor in classifier.state_dict().items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            padding = b'\0'*(-offset % 64)
+            data = array.tobytes()
+            f.write(padding+data)
+            sha1.update(padding+data)
+            offset += len(padding)
+            tensors[name] = dict(dtype=array.dtype.str, shape=list(array.shape), offset=offset)
+            offset += len(data)
+
+    hparams = {}
+    for key,value in classifier.hparams.items():
+        try: hparams[key] = json.loads(json.dumps(value))
+        except TypeError: continue  # not json serializable, not needed for inference
+    header = dict(format='neuston-slim-v1', weights=os.path.basename(weights_path), sha1=sha1.hexdigest(),
+                  hparams=hparams, tensors=tensors)
+    with open(header_path, 'w') as f:
+        json.dump(header, f, indent=1)
+    return header_path, weights_path
+
+
+def load_slim(header_path):
+    """Loads a slim NeustonModel for inference. Its weights are copy-on-write memory-maps,
+       so model replicas on a node share the same pages of physical memory."""
+    with open(header_path) as f:
+        header = json.load(f)
+    hparams = dict(header['hparams'], pretrained=False)
+    classifier = NeustonModel(hparams)
+
+    weights_path = os.path.join(os.path.dirname(header_path), header['weights'])
+    weights = np.memmap(weights_path, dtype='u1', mode='c')
+    for name,meta in header['tensors'].items():
+        array = np.ndarray(meta['shape'], dtype=np.dtype(meta['dtype']), buffer=weights, offset=meta['offset'])
+        tensor = torch.from_numpy(array)
+        module_name, _, attr = name.rpartition('.')
+        module = reduce(getattr, module_name.split('.'), classifier) if module_name else classifier
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+    classifier.eval()
+    return classifier
+
+
+def load_model(model_file):
+    """Loads a NeustonModel from a .ptl checkpoint or a .slim.json inference model"""
+    if model_file.endswith('.slim.json'):
+        return load_slim(model_file)
+    return NeustonModel.load_from_checkpoint(model_file)
+
+
+def test_datasets(pl_module):
+    datasets = pl_module.test_dataloader()
+    if isinstance(datasets, list): return [ds.dataset for ds in datasets]
+    else: return [datasets.dataset]
@@ -9,24 +9,28 @@ import datetime as dt
 
 # 3rd party imports
 import torch
-from torch.utils.data import DataLoader
+import numpy as np
+import pandas as pd
+from torch.utils.data import DataLoader, IterableDataset
 from pytorch_lightning import Trainer, seed_everything
-from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint
+from pytorch_lightning.callbacks import EarlyStopping, LearningRateMonitor
 from pytorch_lightning.loggers.csv_logs import CSVLogger,ExperimentWriter
+from torchvision import transforms
 from torchvision.datasets.folder import IMG_EXTENSIONS
 
 # project imports
 import ifcb
-from neuston_models import NeustonModel
-from neuston_callbacks import SaveValidationResults, SaveTestResults
-from neuston_data import get_trainval_datasets, IfcbBinDataset, ImageDataset
+from neuston_models import NeustonModel, MultiNeustonModel, CascadeNeustonModel, load_model, save_slim, add_prefiltered, get_model_resize, model_stats, format_model_stats
+from neuston_callbacks import SaveValidationResults, AsyncModelCheckpoint, StagedUnfreezing, ProgressiveResize, SaveTestResults, SaveScoreCache, SaveEnsembleResults, SaveFeatureResults
+from neuston_data import get_trainval_datasets, get_trainval_transforms, parse_imgnorm, IfcbBinDataset, ImageDataset, FeatureDataset, BinPrefetcher, BinWatcher
+from neuston_cache import ScoreCache, StitchCache, file_fingerprint
 
 ## NOTES ##
 # https://pytorch-lightning.readthedocs.io/en/0.8.5/introduction_guide.html
 
 def main(args):
 
-    if args.cmd_mode=='TRAIN':
+    if args.cmd_mode in ('TRAIN','LR_FIND'):
         do_training(args)
     else: # RUN
         do_run(args)
@@ -56,32 +60,104 @@ def do_training(args):
     callbacks.extend(validation_results_callbacks)
     callbacks.extend(plotting_callbacks)
     if args.estop:
-        callbacks.append( EarlyStopping('val_loss', patience=args.estop) )
+        # patience is counted in validations
+        callbacks.append( EarlyStopping('val_loss', patience=max(1, args.estop//args.val_every)) )
+    if args.scheduler:
+        callbacks.append(LearningRateMonitor(logging_interval='epoch'))
 
     # Set Seed. If args.seed is 0 ie None, a random seed value is used and stored
     args.seed = seed_everything(args.seed or None)
 
-    #if os.path.isfile(args.MODEL): #TODO: transfer learning option
+    # Transfer learning, MODEL is a previously trained model file
     # see https://pytorch-lightning.readthedocs.io/en/stable/transfer_learning.html?highlight=predictions
+    parent = None
+    args.transfer_from = None
+    if os.path.isfile(args.MODEL):
+        parent = load_model(args.MODEL)
+        args.transfer_from = args.MODEL
+        args.MODEL = parent.hparams.MODEL
+        args.pretrained = False  # weights come from parent
+        if not args.img_norm: args.img_norm = parent.hparams.img_norm
+    if not args.resize:
+        args.resize = parent.hparams.resize if parent is not None else get_model_resize(args.MODEL)
 
     # Setup dataloaders
     training_dataset, validation_dataset = get_trainval_datasets(args)
     assert training_dataset.classes == validation_dataset.classes
     args.classes = training_dataset.classes
+    full_validation_dataset = None
+    if args.val_subset:
+        full_validation_dataset = validation_dataset
+        validation_dataset = validation_dataset.subsample(args.val_subset, seed=args.seed)
+        print('Validating on a {}% subset of {} images, the full {} only when the subset improves'.format(
+              args.val_subset, len(validation_dataset), len(full_validation_dataset)))
     # output list of training and validation images
     with open(os.path.join(args.outdir,'training_images.list'), 'w') as f:
         f.write('\n'.join(sorted(training_dataset.images)))
     with open(os.path.join(args.outdir,'validation_images.list'),'w') as f:
-        f.write('\n'.join(sorted(validation_dataset.images)))
+        f.write('\n'.join(sorted((validation_dataset if full_validation_dataset is None else full_validation_dataset).images)))
 
     # TODO add to args classes removed by class_min and skipped/combined from class_config
 
+    # Setup Model
+    classifier = NeustonModel(args)
+    print(format_model_stats([(args.MODEL, args.resize, model_stats(classifier.model, args.resize))]))
+    # TODO setup dataloaders in the model, allowing auto-batch-size optimization
+    # see https://pytorch-lightning.readthedocs.io/en/stable/training_tricks.html#auto-scaling-of-batch-size
+
+    if parent is not None:
+        kept_classes = classifier.transfer_weights(parent)
+        print('Transfer learning from {}: {} of {} classes warm-started'.format(args.transfer_from, len(kept_classes), len(args.classes)))
+        del parent
+
+    # Knowledge distillation, the teacher's logits for training images are computed once
+    if args.teacher:
+        teacher = load_model(args.teacher)
+        teacher_cache = args.teacher_cache or os.path.join(args.outdir, 'teacher_logits.pt')
+        classifier.teacher_logits = cache_teacher_logits(teacher, training_dataset, teacher_cache, args)
+        print('Distilling from {} ({} @ {}), alpha={} T={}'.format(teacher.hparams.model_id, teacher.hparams.MODEL, teacher.hparams.resize,
+                                                                   args.distill_alpha, args.distill_temperature))
+        del teacher
+
+    # Layer freezing and staged unfreezing
+    if args.freeze:
+        layer_groups = [name for name,_ in classifier.layer_groups()]
+        frozen_groups = len(layer_groups) if args.freeze<0 else args.freeze
+        classifier.freeze_layer_groups(frozen_groups)
+        print('Freezing {} of {} layer groups: {}'.format(frozen_groups, len(layer_groups), ', '.join(layer_groups[:frozen_groups])))
+        if args.unfreeze:
+            callbacks.append(StagedUnfreezing(frozen_groups, args.unfreeze))
+
+    # Frozen backbone, only the classifying head is trained from precomputed features
+    if args.frozen_backbone:
+        assert args.MODEL != 'squeezenet', '--frozen-backbone is not available for squeezenet, its head is not a linear layer'
+        if args.flip: print('WARNING: --flip augmentation has no effect with --frozen-backbone')
+        feature_cache = args.feature_cache or os.path.join(args.outdir, 'backbone_features.pt')
+        datasets = [training_dataset, validation_dataset] + ([] if full_validation_dataset is None else [full_validation_dataset])
+        training_dataset, validation_dataset, *full_validation_dataset = cache_backbone_features(classifier, datasets, feature_cache, args)
+        full_validation_dataset = full_validation_dataset[0] if full_validation_dataset else None
+        classifier.freeze_backbone()
+
+    # Progressive resizing, early epochs train at lower resolutions
+    if args.progressive_resize:
+        assert not args.frozen_backbone, '--progressive-resize cannot be used with --frozen-backbone, features are precomputed at full resolution'
+        make_transforms = lambda size: get_trainval_transforms(args, resize=size)[0]
+        callbacks.append(ProgressiveResize(training_dataset, args.progressive_resize, make_transforms, args.resize))
+
     print('Loading Training Dataloader...')
-    training_loader = DataLoader(training_dataset, pin_memory=True, shuffle=True,
+    # streamed datasets shuffle themselves
+    training_loader = DataLoader(training_dataset, pin_memory=True, shuffle=not isinstance(training_dataset, IterableDataset),
                                  batch_size=args.batch_size, num_workers=args.loaders)
     print('Loading Validation Dataloader...')
     validation_loader = DataLoader(validation_dataset, pin_memory=True, shuffle=False,
                                    batch_size=args.batch_size, num_workers=args.loaders)
+    if full_validation_dataset is not None:
+        classifier.full_validation_loader = DataLoader(full_validation_dataset, pin_memory=True, shuffle=False,
+                                                       batch_size=args.batch_size, num_workers=args.loaders)
+
+    # LR_FIND, a learning rate range test in place of training
+    if args.cmd_mode == 'LR_FIND':
+        return find_learning_rate(classifier, training_loader, args)
 
     # Gerry Rig Logger
     class ExperimentWriter_hack(ExperimentWriter):
@@ -97,22 +173,26 @@ def do_training(args):
     # Setup Trainer
     chkpt_path = os.path.join(args.outdir, 'chkpts')
     os.makedirs(chkpt_path, exist_ok=True)
-    callbacks.append(ModelCheckpoint(dirpath=chkpt_path, monitor='val_loss'))
+    callbacks.append(AsyncModelCheckpoint(dirpath=chkpt_path, monitor='val_loss'))
+    distributed = dict()
+    if args.ddp_cpu:
+        # checkpoints and logs are written by rank 0 only. Datasets are sharded by lightning's DistributedSampler
+        assert not args.gpus, '--ddp-cpu cannot be used with GPUs'
+        os.environ.setdefault('PL_TORCH_DISTRIBUTED_BACKEND', 'gloo')
+        distributed = dict(accelerator='ddp_cpu', num_processes=args.ddp_cpu, num_nodes=args.nodes)
     trainer = Trainer(deterministic=True, logger=logger,
                       gpus=len(args.gpus) if args.gpus else None,
                       max_epochs=args.emax, min_epochs=args.emin,
                       checkpoint_callback=True,
                       callbacks=callbacks,
-                      num_sanity_val_steps=0
+                      num_sanity_val_steps=0,
+                      check_val_every_n_epoch=args.val_every,
+                      **distributed
                       )
 
-    # Setup Model
-    classifier = NeustonModel(args)
-    # TODO setup dataloaders in the model, allowing auto-batch-size optimization
-    # see https://pytorch-lightning.readthedocs.io/en/stable/training_tricks.html#auto-scaling-of-batch-size
-
     # Do Training
     trainer.fit(classifier, train_dataloader=training_loader, val_dataloaders=validation_loader)
+    classifier.head_only = False
 
     # Copy best model
     checkpoint_path = trainer.checkpoint_callback.best_model_path
@@ -128,16 +208,19 @@ def do_training(args):
         output_path = os.path.join(args.outdir, args.args_log)
         copyfile(src_path, output_path)
 
+    # Slim inference model export
+    if args.slim:
+        best_classifier = NeustonModel.load_from_checkpoint(checkpoint_path)
+        for output_path in save_slim(best_classifier, os.path.join(args.outdir, args.model_id+'.slim.json')):
+            print('EXPORTED:', output_path)
+
     # ONNX Export
     if args.onnx:
         classifier.eval()
         classifier.freeze()
         output_path_onnx = os.path.join(args.outdir, args.model_id+'.onnx')
         dummy_batch_size = 10
-        if 'inception' in str(type(classifier.model)):
-            dummy_input = torch.randn(dummy_batch_size,3,299,299,device='cpu')
-        else:
-            dummy_input = torch.randn(dummy_batch_size, 3, 244, 244, device='cpu')
+        dummy_input = torch.randn(dummy_batch_size, 3, args.resize, args.resize, device='cpu')
 
         # perform export
         torch.onnx.export(classifier.model,          # model being run
@@ -160,6 +243,115 @@ def do_training(args):
         print('EXPORTED:', classes_output)
 
 
+def find_learning_rate(classifier, training_loader, args):
+    """Trains for --lr-steps batches at exponentially increasing learning rates, from --lr-min to --lr-max.
+       Losses are written to OUTDIR/lr_find.csv and the learning rate of steepest loss descent is suggested"""
+    assert not args.ddp_cpu, 'LR_FIND cannot be used with --ddp-cpu'
+    classifier.hparams.scheduler = None  # the range test has its own schedule
+    trainer = Trainer(deterministic=True, logger=False, checkpoint_callback=False,
+                      gpus=len(args.gpus) if args.gpus else None,
+                      max_epochs=args.emax, callbacks=[])
+    lr_finder = trainer.tuner.lr_find(classifier, train_dataloader=training_loader,
+                                      min_lr=args.lr_min, max_lr=args.lr_max, num_training=args.lr_steps)
+    output_path = os.path.join(args.outdir, 'lr_find.csv')
+    pd.DataFrame(lr_finder.results).to_csv(output_path, index=False)
+    print('EXPORTED:', output_path)
+    suggestion = lr_finder.suggestion()
+    if suggestion is None:
+        print('No --learning-rate could be suggested, eg the loss did not descend. Inspect the lr,loss curve in {}'.format(output_path))
+    else:
+        print('Suggested --learning-rate: {:.2g}'.format(suggestion))
+
+
+def cache_teacher_logits(teacher, dataset, cache_file, args):
+    """Runs the teacher model once over the images of dataset, at the teacher's own resize and img_norm, caching its logits to cache_file.
+       Logits already in cache_file from the same teacher are reused. Returns (logits, {image_path: row}), logits columns ordered by args.classes"""
+    missing_classes = [c for c in args.classes if c not in teacher.hparams.classes]
+    assert not missing_classes, 'teacher {} does not have classes: {}'.format(args.teacher, ', '.join(missing_classes))
+    teacher_key = dict(model_file=os.path.abspath(args.teacher), model_id=teacher.hparams.model_id, mtime=os.path.getmtime(args.teacher))
+    paths, logits = [], None
+    if os.path.isfile(cache_file):
+        cache = torch.load(cache_file)
+        if cache['teacher'] == teacher_key:
+            paths, logits = cache['paths'], cache['logits']
+        else:
+            print('Teacher logits cache {} is from a different teacher, recomputing'.format(cache_file))
+
+    cached = set(paths)
+    missing = sorted(img for img in dataset.images if img not in cached)
+    if missing:
+        print('Computing teacher logits for {} images...'.format(len(missing)))
+        tforms = [transforms.Resize([teacher.hparams.resize, teacher.hparams.resize]), transforms.ToTensor()]
+        if teacher.hparams.img_norm: tforms.append(transforms.Normalize(*parse_imgnorm(teacher.hparams.img_norm)))
+        missing_dataset = dataset.subset({'': missing})
+        missing_dataset.transforms = transforms.Compose(tforms)  # without augmentation
+        missing_dataset.shuffle = False
+        loader = DataLoader(missing_dataset, batch_size=args.batch_size, num_workers=args.loaders)
+        device = torch.device('cuda' if args.gpus else 'cpu')
+        teacher.to(device).eval()
+        new_logits, new_paths = [], []
+        with torch.no_grad():
+            for i,(input_data,_,input_srcs) in enumerate(loader,1):
+                new_logits.append(teacher(input_data.to(device)).half().cpu())
+                new_paths.extend(input_srcs)
+                if i%100==0: print('{} of {} batches'.format(i, len(loader)), flush=True)
+        teacher.cpu()
+        new_logits = torch.cat(new_logits)
+        logits = new_logits if logits is None else torch.cat([logits, new_logits])
+        paths = paths + new_paths
+        torch.save(dict(teacher=teacher_key, paths=paths, logits=logits), cache_file)
+        print('SAVED:', cache_file)
+
+    columns = [teacher.hparams.classes.index(c) for c in args.classes]
+    rows = {path:row for row,path in enumerate(paths)}
+    return logits[:, columns], rows
+
+
+def cache_backbone_features(classifier, datasets, cache_file, args):
+    """Runs the classifier's backbone once over all images of datasets, caching the features to cache_file.
+       Features already in cache_file from the same backbone are reused. Returns a FeatureDataset for each dataset."""
+    backbone = dict(MODEL=args.MODEL, pretrained=args.pretrained, resize=args.resize, img_norm=args.img_norm,
+                    transfer_from=os.path.abspath(args.transfer_from) if args.transfer_from else None,
+                    transfer_from_sha1=file_fingerprint(args.transfer_from) if args.transfer_from else None)  # parent may be retrained in place
+    paths, features = [], None
+    if os.path.isfile(cache_file):
+        cache = torch.load(cache_file)
+        if cache['backbone'] == backbone:
+            paths, features = cache['paths'], cache['features']
+        else:
+            print('Feature cache {} is from a different backbone, recomputing'.format(cache_file))
+
+    cached = set(paths)
+    missing = sorted({img for dataset in datasets for img in dataset.images if img not in cached})
+    if missing:
+        print('Computing backbone features for {} images...'.format(len(missing)))
+        # resize and img_norm only. Validation transforms may include flips, see --flip x+V
+        tforms = [transforms.Resize([args.resize, args.resize]), transforms.ToTensor()]
+        if args.img_norm: tforms.append(transforms.Normalize(*parse_imgnorm(args.img_norm)))
+        missing_dataset = datasets[-1].subset({'': missing})
+        missing_dataset.transforms = transforms.Compose(tforms)
+        missing_dataset.shuffle = False
+        loader = DataLoader(missing_dataset, batch_size=args.batch_size, num_workers=args.loaders)
+        device = torch.device('cuda' if args.gpus else 'cpu')
+        classifier.to(device).eval()
+        new_features, new_paths = [], []
+        with torch.no_grad():
+            for i,(input_data,_,input_srcs) in enumerate(loader,1):
+                batch_features,_ = classifier.features(input_data.to(device))
+                new_features.append(batch_features.half().cpu())
+                new_paths.extend(input_srcs)
+                if i%100==0: print('{} of {} batches'.format(i, len(loader)), flush=True)
+        classifier.cpu().train()
+        new_features = torch.cat(new_features)
+        features = new_features if features is None else torch.cat([features, new_features])
+        paths = paths + new_paths
+        torch.save(dict(backbone=backbone, paths=paths, features=features), cache_file)
+        print('SAVED:', cache_file)
+
+    rows = {path:row for row,path in enumerate(paths)}
+    return [FeatureDataset(dataset, features, rows) for dataset in datasets]
+
+
 def do_run(args):
 
     # assert correct filter arguments
@@ -169,9 +361,30 @@ def do_run(args):
         if len(args.filter) < 2:
             argparse.ArgumentTypeError('Must be at least one KEYWORD')
 
-    # load model
-    classifier = NeustonModel.load_from_checkpoint(args.MODEL)
-    seed_everything(classifier.hparams.seed)
+    # load models
+    classifiers = [load_model(model) for model in args.MODEL]
+    seed_everything(classifiers[0].hparams.seed)
+    model_ids = [classifier.hparams.model_id for classifier in classifiers]
+    assert len(set(model_ids)) == len(model_ids), 'MODELs must have unique model ids, got {}'.format(model_ids)
+    if args.ensemble:
+        assert len(classifiers) > 1, '--ensemble requires more than one MODEL'
+        assert all(c.hparams.classes == classifiers[0].hparams.classes for c in classifiers), '--ensemble requires MODELs with identical classes'
+    if args.features:
+        assert args.src_type == 'bin', '--features is only available for bins'
+        for classifier in classifiers: classifier.extract_features = True
+    prefilter = None
+    if args.prefilter:
+        assert args.src_type == 'bin', '--prefilter is only available for bins'
+        assert not (args.features or args.score_cache), '--prefilter cannot be combined with --features or --score-cache'
+        for classifier in classifiers:
+            assert args.prefilter_class in classifier.hparams.classes, '--prefilter-class "{}" is not a class of {}'.format(args.prefilter_class, classifier.hparams.model_id)
+        prefilter = (args.prefilter[0], args.prefilter[1], args.prefilter_class)
+    cascade = None
+    if args.cascade:
+        assert len(classifiers) == 1, '--cascade requires a single (full) MODEL'
+        assert not (args.ensemble or args.features or args.score_cache), '--cascade cannot be combined with --ensemble, --features or --score-cache'
+        cascade = CascadeNeustonModel(load_model(args.cascade), classifiers[0], args.cascade_threshold,
+                                      hard_classes=args.cascade_hard_classes or (), report=bool(args.cascade_report))
 
     # ARG CORRECTIONS AND CHECKS
     if os.path.isdir(args.SRC) and not args.SRC.endswith(os.sep): args.SRC = args.SRC+os.sep
@@ -184,9 +397,34 @@ def do_run(args):
     # Setup Callbacks
     plotting_callbacks = []  # TODO
     run_results_callbacks = []
-    for outfile in args.outfile:
-        svr = SaveTestResults(outdir=args.outdir, outfile=outfile, timestamp=args.cmd_timestamp)
-        run_results_callbacks.append(svr)
+    for model_id, outdir in zip(model_ids, args.outdirs):
+        for outfile in args.outfile:
+            svr = SaveTestResults(outdir=outdir, outfile=outfile, timestamp=args.cmd_timestamp, model_id=model_id)
+            run_results_callbacks.append(svr)
+    if args.ensemble:
+        ensemble = SaveEnsembleResults(model_ids, outdir=args.ensemble_outdir, outfiles=args.outfile,
+                                       timestamp=args.cmd_timestamp, ensemble_id=args.ensemble)
+        run_results_callbacks.append(ensemble)
+
+    # penultimate-layer features
+    feature_callbacks = {}
+    if args.features:
+        for model_id, outdir in zip(model_ids, args.outdirs):
+            feature_callbacks[model_id] = SaveFeatureResults(outdir, model_id)
+        run_results_callbacks.extend(feature_callbacks.values())
+
+    # raw score cache, results may be regenerated from it without re-inference
+    score_caches = {}
+    if args.score_cache and args.src_type == 'bin':
+        max_size = int(args.score_cache_size*2**30) if args.score_cache_size else None
+        for model_id, model_path in zip(model_ids, args.MODEL):
+            score_cache = ScoreCache(args.score_cache, model_id, model_path, max_size)
+            if args.score_cache_clear: score_cache.clear()
+            score_caches[model_id] = score_cache
+            run_results_callbacks.append(SaveScoreCache(score_cache))
+
+    # stitched images of old-style bins, shared by all models
+    stitch_cache = StitchCache(args.stitch_cache) if args.stitch_cache and args.src_type == 'bin' else None
 
     # create trainer
     trainer = Trainer(deterministic=True,
@@ -195,6 +433,19 @@ def do_run(args):
                       callbacks=run_results_callbacks,
                       )
 
+    # models with the same resize and img_norm share dataloaders and are run together
+    preprocess_groups = {}
+    for classifier in classifiers:
+        preprocess_key = (classifier.hparams.resize, str(classifier.hparams.img_norm))
+        preprocess_groups.setdefault(preprocess_key, []).append(classifier)
+    test_modules = {}
+    def test_module(group):
+        group = tuple(group)
+        if group not in test_modules:
+            if cascade: test_modules[group] = cascade
+            else: test_modules[group] = group[0] if len(group)==1 else MultiNeustonModel(group)
+        return test_modules[group]
+
     # dataset filter if any
     filter_mode, filter_keywords = None,[]
     if args.filter:
@@ -207,7 +458,6 @@ def do_run(args):
                 filter_keywords.append(keyword)
 
     # create dataset
-    image_loaders = []
     if args.src_type == 'bin':
         # Formatting Dataset
         if os.path.isdir(args.SRC):
@@ -228,50 +478,130 @@ def do_run(args):
             dd = ifcb.DataDirectory(parent,whitelist=[bin_id])
 
         error_bins = []
+        gobig_loaders = {}
+
+        # watch mode, the model stays loaded and bins are classified as they are completed
+        watcher = None
+        if args.watch:
+            assert os.path.isdir(args.SRC), '--watch requires SRC to be a data directory'
+            assert not args.gobig, '--watch cannot be combined with --gobig'
+            os.makedirs(args.outdir, exist_ok=True)
+            watcher = BinWatcher(args.SRC, interval=args.watch, settle=args.watch_settle,
+                                 metrics_file=os.path.join(args.outdir, 'watch_latency.csv'))
+            print('Watching {} for new bins every {}s. Ctrl-C to stop'.format(args.SRC, args.watch))
+
+        def watch_done(bin_fileset, classified):
+            if watcher: watcher.done(bin_fileset, classified)
+
+        def bins_to_run():
+            for bin_fileset in (watcher or dd):
+                bin_fileset.pid.namespace = os.path.dirname(bin_fileset.fileset.basepath.replace(args.SRC,''))+os.sep
+                bin_obj = bin_fileset.pid
+                if args.filter: # applying filter
+                    if filter_mode=='IN': # if bin does NOT match any of the keywords, skip it
+                        if not any([k in str(bin_obj) for k in filter_keywords]):
+                            watch_done(bin_fileset, classified=False)
+                            continue
+                    elif filter_mode=='OUT': # if bin matches any of the keywords, skip it
+                        if any([k in str(bin_obj) for k in filter_keywords]):
+                            watch_done(bin_fileset, classified=False)
+                            continue
+
+                # models whose result-file(s) are missing. An ensemble needs every model's results.
+                pending = list(classifiers)
+                if not args.clobber:
+                    pending = [c for c,outdir in zip(classifiers,args.outdirs) if not bin_outfiles_exist(outdir, args.outfile, bin_obj)
+                               or args.features and not feature_callbacks[c.hparams.model_id].has(bin_obj.pid)]
+                    if args.ensemble and (pending or not bin_outfiles_exist(args.ensemble_outdir, args.outfile, bin_obj)):
+                        pending = list(classifiers)
+                    if not pending:
+                        print('{} result-file(s) already exist - skipping this bin'.format(bin_obj))
+                        watch_done(bin_fileset, classified=False)
+                        continue
+
+                for classifier in pending[:]:
+                    model_id = classifier.hparams.model_id
+                    if model_id not in score_caches or bin_obj.pid not in score_caches[model_id]: continue
+                    if args.features and not feature_callbacks[model_id].has(bin_obj.pid): continue  # features are not cached
+                    roi_numbers, output_scores = score_caches[model_id].get(bin_obj.pid)
+                    rr = NeustonModel.RunResults(inputs=roi_numbers, outputs=output_scores, input_obj=bin_obj,
+                                                 model_id=model_id, class_labels=classifier.hparams.classes)
+                    for callback in run_results_callbacks:
+                        if isinstance(callback, (SaveTestResults,SaveEnsembleResults)): callback.save(rr)
+                    print('{} {} result-file(s) regenerated from score-cache'.format(bin_obj, model_id))
+                    pending.remove(classifier)
+                if not pending:
+                    watch_done(bin_fileset, classified=True)
+                    continue
+
+                yield bin_fileset, pending
+
+        def load_bin(bin_fileset, read_bin, pending):
+            # bin images are read and decoded once, for all models
+            bin_dataset = IfcbBinDataset(read_bin, pending[0].hparams.resize, pending[0].hparams.img_norm,
+                                         stitch_cache=stitch_cache, prefilter=prefilter)
+            bin_dataset.bin = bin_fileset  # read_bin may be a staged copy, without the namespaced pid
+            return bin_dataset
+
+        # upcoming bins are read and decoded in background threads
+        # in watch mode, the next bin may not exist yet, so bins are not read ahead
+        prefetcher = BinPrefetcher(bins_to_run(), load_bin, max_bins=0 if watcher else args.prefetch,
+                                   max_bytes=int(args.prefetch_mem*2**20), stage_dir=args.stage)
 
         if args.gobig: print('Loading Bins',end=' ')
-        for i, bin_fileset in enumerate(dd):
-            bin_fileset.pid.namespace = os.path.dirname(bin_fileset.fileset.basepath.replace(args.SRC,''))+os.sep
+        for bin_fileset, pending, bin_dataset in prefetcher:
             bin_obj = bin_fileset.pid
-            if args.filter: # applying filter
-                if filter_mode=='IN': # if bin does NOT match any of the keywords, skip it
-                    if not any([k in str(bin_obj) for k in filter_keywords]): continue
-                elif filter_mode=='OUT': # if bin matches any of the keywords, skip it
-                    if any([k in str(bin_obj) for k in filter_keywords]): continue
-
-            if not args.clobber:
-                output_files = [os.path.join(args.outdir, ofile) for ofile in args.outfile]
-                outfile_dict = dict(BIN_ID=bin_obj.pid,
-                                    BIN_YEAR=bin_obj.year,
-                                    BIN_DATE=bin_obj.yearday,
-                                    INPUT_SUBDIRS=bin_obj.namespace)
-                output_files = [ofile.format(**outfile_dict).replace(2*os.sep,os.sep) for ofile in output_files]
-                if all([ os.path.isfile(ofile) for ofile in output_files ]):
-                    print('{} result-file(s) already exist - skipping this bin'.format(bin_obj))
+            classified = False  # whether this bin's result-file(s) were written
+            try:
+                if isinstance(bin_dataset, Exception):
+                    error_bins.append((bin_obj, bin_dataset))
                     continue
 
-            bin_dataset = IfcbBinDataset(bin_fileset, classifier.hparams.resize, classifier.hparams.img_norm)
-            image_loader = DataLoader(bin_dataset, batch_size=args.batch_size,
-                                      pin_memory=True, num_workers=args.loaders)
+                # bins whose ROIs were all prefiltered need no inference
+                if len(bin_dataset) == 0 and bin_dataset.prefiltered:
+                    for classifier in pending:
+                        rr = NeustonModel.RunResults(inputs=np.zeros(0,dtype='u4'), outputs=np.zeros((0,len(classifier.hparams.classes)),dtype='f4'), input_obj=bin_obj,
+                                                     model_id=classifier.hparams.model_id, class_labels=classifier.hparams.classes)
+                        add_prefiltered(rr, bin_dataset)
+                        for callback in run_results_callbacks:
+                            if isinstance(callback, (SaveTestResults,SaveEnsembleResults)): callback.save(rr)
+                    classified = True
+                    continue
 
-            # skip empty bins
-            if len(image_loader) == 0:
-                error_bins.append((bin_obj, AssertionError('Bin is Empty')))
-                continue
-            if args.gobig:
-                print('.',end='',flush=True)
-                image_loaders.append(image_loader)
-            else:
-                # Do runs one bin at a time
-                try: trainer.test(classifier, test_dataloaders=image_loader)
-                except Exception as e:
-                    error_bins.append((bin_obj,e))
+                # skip empty bins
+                if len(bin_dataset) == 0:
+                    error_bins.append((bin_obj, AssertionError('Bin is Empty')))
+                    continue
+                if args.gobig: print('.',end='',flush=True)
+
+                for group in preprocess_groups.values():
+                    group = [c for c in group if c in pending]
+                    if not group: continue
+                    group_dataset = bin_dataset.with_transforms(group[0].hparams.resize, group[0].hparams.img_norm,
+                                                                screen_resize=cascade.screen.hparams.resize if cascade else None)
+                    image_loader = DataLoader(group_dataset, batch_size=args.batch_size,
+                                              pin_memory=True, num_workers=args.loaders)
+                    if args.gobig:
+                        gobig_loaders.setdefault(tuple(group),[]).append(image_loader)
+                    else:
+                        # Do runs one bin at a time
+                        try: trainer.test(test_module(group), test_dataloaders=image_loader)
+                        except Exception as e:
+                            error_bins.append((bin_obj,e))
+                classified = not (error_bins and error_bins[-1][0] is bin_obj)
+            finally:
+                watch_done(bin_fileset, classified)
 
         # Do Runs all at once
-        if args.gobig: print(); trainer.test(classifier, test_dataloaders=image_loaders)
+        if args.gobig:
+            print()
+            for group,image_loaders in gobig_loaders.items():
+                trainer.test(test_module(group), test_dataloaders=image_loaders)
 
         # Final Statements
         print('RUN IS DONE')
+        if args.prefetch and not watcher:
+            print('Prefetch: {:.1f}s waiting on bin I/O, {:.1f}s reading bins in background'.format(prefetcher.io_wait, prefetcher.read_time))
         if error_bins:
             print("The following bins failed; they were not processed:")
             for bin_obj,err in error_bins:
@@ -301,11 +631,39 @@ def do_run(args):
                     if any([k in img for k in filter_keywords]): img_paths.remove(img)
 
         assert len(img_paths)>0, 'No images to process'
-        image_dataset = ImageDataset(img_paths, resize=classifier.hparams.resize, input_src=args.SRC)
-        image_loader = DataLoader(image_dataset, batch_size=args.batch_size,
-                                  pin_memory=True, num_workers=args.loaders)
+        for group in preprocess_groups.values():
+            image_dataset = ImageDataset(img_paths, resize=group[0].hparams.resize, input_src=args.SRC,
+                                         screen_resize=cascade.screen.hparams.resize if cascade else None)
+            image_loader = DataLoader(image_dataset, batch_size=args.batch_size,
+                                      pin_memory=True, num_workers=args.loaders)
 
-        trainer.test(classifier,test_dataloaders=image_loader)
+            trainer.test(test_module(group),test_dataloaders=image_loader)
+
+    if cascade and cascade.report:
+        write_cascade_report(cascade, args.cascade_report)
+
+
+def write_cascade_report(cascade, outfile):
+    """per-input counts of scored and escalated images, and agreement of the cascade and screening model with the full model alone.
+       ROIs assigned by --prefilter were not scored, and are not counted"""
+    columns = ['input','rois','escalated','cascade_agree','screen_agree']
+    df = pd.DataFrame([[str(row[0])]+row[1:] for row in cascade.report_rows], columns=columns)
+    df.to_csv(outfile, index=False)
+    totals = df[columns[1:]].sum()
+    if totals.rois:
+        print('Cascade: {:.1%} of {} images escalated to the full model. Agreement with full model alone: cascade {:.2%}, screening model {:.2%}'.format(
+              totals.escalated/totals.rois, totals.rois, totals.cascade_agree/totals.rois, totals.screen_agree/totals.rois))
+    print('CASCADE REPORT:', outfile)
+
+
+def bin_outfiles_exist(outdir, outfiles, bin_obj):
+    output_files = [os.path.join(outdir, ofile) for ofile in outfiles]
+    outfile_dict = dict(BIN_ID=bin_obj.pid,
+                        BIN_YEAR=bin_obj.year,
+                        BIN_DATE=bin_obj.yearday,
+                        INPUT_SUBDIRS=bin_obj.namespace)
+    output_files = [ofile.format(**outfile_dict).replace(2*os.sep,os.sep) for ofile in output_files]
+    return all([ os.path.isfile(ofile) for ofile in output_files ])
 
 
 def argparse_nn(parser=None):
@@ -318,6 +676,7 @@ def argparse_nn(parser=None):
     subparsers = parser.add_subparsers(dest='cmd_mode', help='These sub-commands are mutually exclusive. Note: optional arguments (below) must be specified before "TRAIN" or "RUN"')
     train = subparsers.add_parser('TRAIN', help='Train a new model')
     run = subparsers.add_parser('RUN', help='Run a previously trained model')
+    lr_find = subparsers.add_parser('LR_FIND', help='Find a --learning-rate for TRAIN with a learning rate range test. Takes the same arguments as TRAIN')
 
     ## Common Vars ##
     common = parser.add_argument_group(title='NN Common Args', description=None)
@@ -326,14 +685,30 @@ def argparse_nn(parser=None):
 
     argparse_nn_train(train)
     argparse_nn_run(run)
+    argparse_nn_train(lr_find)
+    argparse_nn_lr_find(lr_find)
 
     return parser
 
+def size_epochs(arg):
+    """parses a "SIZE:EPOCHS" --progressive-resize phase"""
+    try:
+        size, epochs = map(int, arg.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected SIZE:EPOCHS, eg "128:4", got "{}"'.format(arg))
+    return size, epochs
+
 def argparse_nn_train(train_subparser):
     ## Training Vars ##
-    train_subparser.add_argument('SRC', help='Directory with class-label subfolders and images. May also be a dataset-configuration csv.')
-    train_subparser.add_argument('MODEL', help='Select a base model. Eg: "inception_v3"')
-    # TODO choices field. TODO: "Accepts a known model name, or a path to a specific model file for transfer learning"
+    train_subparser.add_argument('SRC', help='Directory with class-label subfolders and images. May also be a dataset-configuration csv, a directory of shards made by "neuston_util.py PACK", '
+                                                 'or an annotation csv of bin_id,roi_number,label rows whose ROIs are read directly from bins (see --bin-dir).')
+    train_subparser.add_argument('MODEL', help='Select a base model. Eg: "inception_v3", "resnet50", "densenet121". '
+                                               'With a newer torchvision than the pinned 0.8.2, also "mobilenet_v3_large" (>=0.9), '
+                                               '"efficientnet_b0", "regnet_y_800mf" (>=0.11) and "convnext_tiny" (>=0.12). '
+                                               'Compare models with "neuston_util.py MODEL_STATS". '
+                                               'May also be a previously trained .ptl model file for transfer learning, '
+                                               'in which case the heads of classes it shares with SRC keep their trained weights')
+    # TODO choices field.
     train_subparser.add_argument('TRAIN_ID', help='Training ID. This value is the default value used by --outdir and --model-id.')
 
     model = train_subparser.add_argument_group(title='Model Adjustments', description=None)
@@ -342,7 +717,32 @@ def argparse_nn_train(train_subparser):
     model.add_argument('--img-norm', nargs=2, metavar=('MEAN', 'STD'),
                        help='Normalize images by MEAN and STD. This is like whitebalancing. '
                             'eg1: "0.667 0.161", eg2: "0.056,0.058,0.051 0.067,0.071,0.057"')
-    # TODO layer freezing and transfer learning params.
+    model.add_argument('--frozen-backbone', action='store_true',
+                       help='If set, MODEL\'s backbone is frozen and run once over all images to create a feature cache. '
+                            'Only the classifying head is then trained, from cached features. Augmentations are not applied')
+    model.add_argument('--feature-cache', metavar='FILE',
+                       help='Backbone feature cache file for --frozen-backbone. Reuse FILE across trainings (eg with different --class-config) '
+                            'to skip recomputing features. Default is OUTDIR/backbone_features.pt')
+    model.add_argument('--freeze', metavar='N', default=0, type=int,
+                       help='Freeze the first N layer groups of MODEL, counted from the input. Set N=-1 to freeze all but the classifying head. Default is 0')
+    model.add_argument('--unfreeze', metavar='EPOCHS', type=int,
+                       help='Staged unfreezing of --freeze layer groups: every EPOCHS epochs the deepest frozen layer group is unfrozen')
+
+    model.add_argument('--resize', metavar='N', type=int,
+                       help='Input image size NxN. Stored with the model, RUN and ONNX export use the same size. '
+                            'Lower sizes cut FLOPs quadratically, see "neuston_util.py BENCH_RESIZE". '
+                            'Default is MODEL\'s pretraining size, eg 299 for inception_v3 and 224 for most others')
+    model.add_argument('--progressive-resize', metavar='SIZE:EPOCHS', nargs='+', type=size_epochs,
+                       help='Train at lower resolutions first, eg "128:4 192:4" trains 4 epochs at 128x128, 4 at 192x192, then at full resolution. '
+                            'Validation and saved models are always at full resolution')
+
+    distill = train_subparser.add_argument_group(title='Knowledge Distillation', description='Train MODEL as a student of a previously trained teacher model')
+    distill.add_argument('--teacher', metavar='PTL', help='Teacher model .ptl or .slim.json file. Its classes must include all of SRC\'s classes')
+    distill.add_argument('--teacher-cache', metavar='FILE',
+                         help='Teacher logits cache file. Reuse FILE across student trainings to skip rerunning the teacher. Default is OUTDIR/teacher_logits.pt')
+    distill.add_argument('--distill-alpha', metavar='A', default=0.5, type=float,
+                         help='Weight of the soft-target loss. The hard-label loss is weighted by 1-A. Default is 0.5')
+    distill.add_argument('--distill-temperature', metavar='T', default=4, type=float, help='Softmax temperature of soft targets. Default is 4')
 
     data = train_subparser.add_argument_group(title='Dataset Adjustments', description=None)
     data.add_argument('--seed', default=0, type=int, help='Set a specific seed for deterministic output & dataset-splitting reproducability.')
@@ -351,6 +751,12 @@ def argparse_nn_train(train_subparser):
     data.add_argument('--class-min', metavar='MIN', default=2, type=int, help='Exclude classes with fewer than MIN instances. Default is 2')
     data.add_argument('--class-max', metavar='MAX', default=None, type=int, help='Limit classes to a MAX number of instances. '
                            'If multiple datasets are specified with a dataset-configuration csv, classes from lower-priority datasets are truncated first.')
+    data.add_argument('--dedup', default=False, action='store_true',
+                      help='For SRC dataset-configuration csvs, drop images duplicated across datasets by content hash, keeping the highest-priority copy. '
+                           'Conflicting labels are reported. Hashes are cached in a .image_hashes.csv of each dataset')
+    data.add_argument('--bin-dir', metavar='DIR', help='For SRC annotation csvs, the IFCB data directory holding the annotated bins. Default is the folder of SRC')
+    data.add_argument('--shuffle-buffer', metavar='N', default=1000, type=int,
+                      help='For SRC shards or annotation csvs, training images are shuffled within a buffer of N images as they are streamed. Default is 1000')
     data.add_argument('--swap', default=False, action='store_true',
                       help=argparse.SUPPRESS)  # dupes placeholder. may not be needed.
 
@@ -358,17 +764,29 @@ def argparse_nn_train(train_subparser):
     epochs.add_argument('--emax', metavar='MAX', default=60, type=int, help='Maximum number of training epochs. Default is 60')
     epochs.add_argument('--emin', metavar='MIN', default=10, type=int, help='Minimum number of training epochs. Default is 10')
     epochs.add_argument('--estop', metavar='STOP', default=10, type=int, help='Early Stopping: Number of epochs following a best-epoch after-which to stop training. Set STOP=0 to disable. Default is 10')
+    epochs.add_argument('--val-every', metavar='N', default=1, type=int, help='Validate every N epochs. Default is 1')
+    epochs.add_argument('--val-subset', metavar='PERCENT', type=float,
+                        help='Validate every epoch on a fixed, stratified PERCENT of the validation set. The full validation set is only run, '
+                             'and results files written, when the subset\'s val_loss improves. Checkpointing and early stopping follow the subset\'s val_loss')
 
     augs = train_subparser.add_argument_group(title='Augmentation Options', description='Data Augmentation is a technique by which training results may improved by simulating novel input')
     augs.add_argument('--flip', choices=['x', 'y', 'xy', 'x+V', 'y+V', 'xy+V'],
                       help='Training images have 50%% chance of being flipped along the designated axis: (x) vertically, (y) horizontally, (xy) either/both. May optionally specify "+V" to include Validation dataset')
 
+    dist = train_subparser.add_argument_group(title='Distributed Training', description='Data-parallel training on CPUs, over gloo')
+    dist.add_argument('--ddp-cpu', metavar='N', type=int,
+                      help='Train with N processes per node. The node\'s cores are divided among processes. '
+                           'Several local processes on a single machine are fine, eg for testing')
+    dist.add_argument('--nodes', metavar='M', default=1, type=int,
+                      help='Number of nodes for --ddp-cpu. Multi-node training requires SLURM, or MASTER_ADDR, MASTER_PORT and NODE_RANK environment variables. Default is 1')
+
     out = train_subparser.add_argument_group(title='Output Options')
     out.add_argument('--outdir', default='training-output/{TRAIN_ID}', help='Default is "training-output/{TRAIN_ID}"')
     out.add_argument('--model-id', default='{TRAIN_ID}', help='Set a specific model id. Patterns {TRAIN_DATE} and {TRAIN_ID} are recognized. Default is "{TRAIN_ID}"')
     out.add_argument('--epochs-log', metavar='ELOG', default='epochs.csv', help='Specify a csv filename. Includes epoch, loss, validation loss, and f1 scores. Default is epochs.csv')
     out.add_argument('--args-log', metavar='ALOG', default='args.yml', help='Specify a human-readable yaml filename. Includes all user-specified and default training parameters. Default is args.yml')
     out.add_argument('--onnx', action='store_true', help='Additionally output an onnx version of the model')
+    out.add_argument('--slim', action='store_true', help='Additionally output an inference-only version of the model: a .slim.json hparams header and memory-mappable .slim.weights')
     out.add_argument('--results', dest='result_files', metavar=('FNAME', 'SERIES'), nargs='+', action='append',
                      help='FNAME: Specify a validation-results filename or pattern. Valid patterns are: "{epoch}". Accepts .json .h5 and .mat file formats.'
                           'SERIES: Data to include in FNAME. The following are always included and need not be specified: model_id, timestamp, class_labels, input_classes, output_classes.'
@@ -382,10 +800,17 @@ def argparse_nn_train(train_subparser):
     meta.add_argument('--dataset-id', help='Associate a dataset id label with this model')
     meta.add_argument('--notes', help='Add any kind of note to the trained model. Make sure to use quotes "around your message."')
 
-    #optim = train_subparser.add_argument_group(title='Optimization', description='Adjust learning hyper parameters')
-    #optim.add_argument('--optimizer', default='Adam', choices=['Adam'], help='Select and optimizer. Default is Adam')
-    #optim.add_argument('--learning-rate',default=0.001,type=float,help='Set a learning rate. Default is 0.001')
-    #optim.add_argument('--weight-decay', default='?', help="not sure where this comes in")
+    optim = train_subparser.add_argument_group(title='Optimization', description='Adjust learning hyper parameters')
+    optim.add_argument('--optimizer', default='Adam', choices=['Adam','AdamW','SGD'], help='Select an optimizer. SGD uses nesterov momentum. Default is Adam')
+    optim.add_argument('--learning-rate', metavar='LR', default=0.001, type=float, help='Set a learning rate, the peak learning rate of a --scheduler. See LR_FIND. Default is 0.001')
+    optim.add_argument('--weight-decay', metavar='WD', default=0, type=float, help='L2 penalty (decoupled for AdamW). Default is 0')
+    optim.add_argument('--momentum', default=0.9, type=float, help='Momentum for SGD. Default is 0.9')
+    optim.add_argument('--scheduler', choices=['onecycle','cosine','plateau'],
+                       help='Learning rate schedule. "onecycle" and "cosine" anneal over --emax epochs after --warmup epochs, '
+                            '"plateau" reduces the learning rate by --lr-factor once val_loss has not improved for --lr-patience epochs. Default is a constant learning rate')
+    optim.add_argument('--warmup', metavar='EPOCHS', default=1, type=float, help='Warmup epochs of "onecycle" and "cosine" schedules. Default is 1')
+    optim.add_argument('--lr-patience', metavar='EPOCHS', default=3, type=int, help='Patience of the "plateau" schedule. Default is 3')
+    optim.add_argument('--lr-factor', metavar='F', default=0.1, type=float, help='Learning rate reduction factor of the "plateau" schedule. Default is 0.1')
     #optim.add_argument('--class-norm', help='Bias results to emphasize smaller classes')
     #optim.add_argument('--batch-norm', help='i forget what this is exactly')
 
@@ -393,7 +818,8 @@ def argparse_nn_train(train_subparser):
 def argparse_nn_run(run_subparser):
     ## Run Vars ##
     run_subparser.add_argument('SRC', help='Resource(s) to be classified. Accepts a bin, an image, a text-file, or a directory. Directories are accessed recursively')
-    run_subparser.add_argument('MODEL', help='Path to a previously-trained model file')
+    run_subparser.add_argument('MODEL', nargs='+', help='Path to a previously-trained model file (.ptl or .slim.json). '
+        'Multiple MODELs may be specified, in which case each bin is read only once and each model\'s results are saved to its own {MODEL_ID} OUTDIR')
     run_subparser.add_argument('RUN_ID', help='Run ID. Used by --outdir')
 
     run_subparser.add_argument('--type', dest='src_type', default='bin', choices=['bin','img'], help='File type to perform classification on. Defaults is "bin"')
@@ -409,10 +835,56 @@ def argparse_nn_run(run_subparser):
         help='Explicitly include (IN) or exclude (OUT) bins or image-files by KEYWORDs. KEYWORD may also be a text file containing KEYWORDs, line-deliminated.')
     run_subparser.add_argument('--clobber', action='store_true',
         help='If set, already processed bins in OUTDIR are reprocessed. By default, if an OUTFILE exists already the associated bin is not reprocessed.')
+    run_subparser.add_argument('--features', action='store_true',
+        help='Additionally save the penultimate-layer features of every ROI to OUTDIR/features/ as a memory-mappable float16 array, '
+             'with roi_numbers.u32 and bins.csv index files. Only available for bins')
+    run_subparser.add_argument('--ensemble', metavar='ENSEMBLE_ID',
+        help='If multiple MODELs are specified, additionally save their averaged scores as model ENSEMBLE_ID. MODELs must have identical classes. '
+             'ENSEMBLE_ID replaces {MODEL_ID} in OUTDIR')
+    run_subparser.add_argument('--prefilter', metavar=('W','H'), nargs=2, type=int,
+        help='ROIs narrower than W or shorter than H pixels, as per the ADC file, are assigned --prefilter-class without being decoded or classified. '
+             'Results mark these ROIs in a "prefiltered" series. Only available for bins')
+    run_subparser.add_argument('--prefilter-class', metavar='CLASS', default='detritus',
+        help='Class assigned to --prefilter\'d ROIs. Must be a class of every MODEL. Default is "detritus"')
+    run_subparser.add_argument('--cascade', metavar='SCREEN_MODEL',
+        help='Confidence cascade. A small, fast SCREEN_MODEL scores every image first, and only images it scores below --cascade-threshold '
+             '(or as a --cascade-hard-classes class) are scored by MODEL. Models must have identical classes and img_norm. '
+             'Results record the stage (0:screen, 1:MODEL, 255:--prefilter, not scored) of each score as "output_stages"')
+    run_subparser.add_argument('--cascade-threshold', metavar='T', default=0.9, type=float,
+        help='Images with a winning screening score below T are escalated to MODEL. Default is 0.9')
+    run_subparser.add_argument('--cascade-hard-classes', metavar='CLASS', nargs='+',
+        help='Images the screening model assigns to any of these classes are always escalated to MODEL')
+    run_subparser.add_argument('--cascade-report', metavar='CSV',
+        help='Also score every image with MODEL alone, and write the cascade\'s per-input agreement with it to CSV. Slower than no cascade; for tuning only')
+    run_subparser.add_argument('--score-cache', metavar='DIR',
+        help='Cache raw bin scores per model in DIR. Bins found in the cache have their OUTFILEs written from the cache without re-running the model. '
+             'The cache of a model is cleared automatically when its MODEL file changes.')
+    run_subparser.add_argument('--score-cache-size', metavar='GB', type=float,
+        help='Maximum size of a model\'s score-cache. Least-recently-used bins are evicted first. Default is unlimited')
+    run_subparser.add_argument('--score-cache-clear', action='store_true', help='If set, the score-cache of MODEL is cleared before running')
+    run_subparser.add_argument('--stitch-cache', metavar='DIR',
+        help='Cache the stitched and infilled images of old-style (schema v1) bins in DIR, so that later runs (of any model) skip stitching')
+    run_subparser.add_argument('--prefetch', metavar='K', default=2, type=int,
+        help='Number of upcoming bins to read and decode in background threads while the current bin is classified. Set K=0 to disable. Default is 2')
+    run_subparser.add_argument('--prefetch-mem', metavar='MB', default=2048, type=float,
+        help='Maximum raw size of bins being prefetched at once. Default is 2048MB')
+    run_subparser.add_argument('--stage', metavar='DIR',
+        help='Copy raw bin files to DIR (eg node-local scratch) before reading them. Staged files are removed once read')
+    run_subparser.add_argument('--watch', metavar='SECONDS', type=float,
+        help='Keep running, polling SRC every SECONDS for newly completed bins and classifying them as they appear. '
+             'Latency from bin completion to classification is logged to OUTDIR/watch_latency.csv')
+    run_subparser.add_argument('--watch-settle', metavar='SECONDS', default=30, type=float,
+        help='With --watch, a bin is complete once its .hdr, .adc and .roi files exist and have not been modified for SECONDS. Default is 30')
     run_subparser.add_argument('--gobig', action='store_true', help=argparse.SUPPRESS)  # aggregates bins
     #run_subparser.add_argument('-p','--plot', metavar=('FNAME','PARAM'), nargs='+', action='append', help='Make Plots') # TODO plots
 
-def argparse_nn_runtimeparams(args):
+def argparse_nn_lr_find(lr_find_subparser):
+    lr_find = lr_find_subparser.add_argument_group(title='Learning Rate Range Test')
+    lr_find.add_argument('--lr-min', metavar='LR', default=1e-7, type=float, help='Learning rate of the first step. Default is 1e-7')
+    lr_find.add_argument('--lr-max', metavar='LR', default=1, type=float, help='Learning rate of the last step. Default is 1')
+    lr_find.add_argument('--lr-steps', metavar='N', default=100, type=int, help='Number of batches trained, each at a higher learning rate. Default is 100')
+
+def argparse_nn_runtimeparams(args, parser=None):
     # add timestamp
     args.cmd_timestamp = dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds')
 
@@ -432,23 +904,33 @@ def argparse_nn_runtimeparams(args):
     else: args.gpus = None
 
     # parse args.outdir value
-    proc_outdir(args)
+    proc_outdir(args, parser)
 
 
-def proc_outdir(args):
+def proc_outdir(args, parser=None):
     run_date_str, run_time_str = args.cmd_timestamp.split('T')
-    if args.cmd_mode=='TRAIN':
+    if args.cmd_mode in ('TRAIN','LR_FIND'):
         args.outdir = args.outdir.format(TRAIN_DATE=run_date_str, TRAIN_ID=args.TRAIN_ID)
     elif args.cmd_mode=='RUN':
-        model_id = NeustonModel.load_from_checkpoint(args.MODEL).hparams.model_id
-        args.outdir = args.outdir.format(RUN_DATE=run_date_str, RUN_ID=args.RUN_ID, MODEL_ID=model_id)
+        outdir_pattern = args.outdir
+        if len(args.MODEL) > 1 and '{MODEL_ID}' not in outdir_pattern:
+            msg = 'multiple MODELs require an --outdir with a {{MODEL_ID}} pattern, otherwise their results overwrite each other. Got "{}"'.format(outdir_pattern)
+            if parser: parser.error(msg)
+            raise ValueError(msg)
+        args.outdirs = []
+        for model in args.MODEL:
+            model_id = load_model(model).hparams.model_id
+            args.outdirs.append(outdir_pattern.format(RUN_DATE=run_date_str, RUN_ID=args.RUN_ID, MODEL_ID=model_id))
+        if args.ensemble:
+            args.ensemble_outdir = outdir_pattern.format(RUN_DATE=run_date_str, RUN_ID=args.RUN_ID, MODEL_ID=args.ensemble)
+        args.outdir = args.outdirs[0] if len(args.outdirs)==1 else os.path.commonpath(args.outdirs)
 
 
 if __name__ == '__main__':
 
     parser = argparse_nn()
     input_args = parser.parse_args()
-    argparse_nn_runtimeparams(input_args)
+    argparse_nn_runtimeparams(input_args, parser)
     main(input_args)
 
 # TODO move dataloaders to NeustonModel for auto-batch-size enabling
@@ -6,7 +6,7 @@ import argparse
 
 import torch.onnx
 from pytorch_lightning import seed_everything
-from neuston_models import NeustonModel
+from neuston_models import load_model
 from neuston_data import ImageDataset
 from scipy.special import softmax
 from PIL import Image
@@ -17,7 +17,7 @@ IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tif
 def do_export(args):
 
     # load model
-    classifier = NeustonModel.load_from_checkpoint(args.MODEL)
+    classifier = load_model(args.MODEL)
     classes = classifier.hparams.classes
     seed_everything(classifier.hparams.seed)
     classifier.eval()
@@ -28,16 +28,15 @@ def do_export(args):
         output = args.output
         os.makedirs(os.path.dirname(output), exist_ok=True)
     else:
-        output = args.MODEL.replace('.ptl','.onnx')
+        output = args.MODEL[:-len('.slim.json')] if args.MODEL.endswith('.slim.json') else os.path.splitext(args.MODEL)[0]
+        output = output+'.onnx'
         if args.half: output = output.replace('.onnx','.FP16.onnx')
 
     print(str(type(classifier.model)))
     
     dummy_batch_size = args.batchsize if args.batchsize else 10
-    if 'inception' in str(type(classifier.model)):
-        dummy_input = torch.randn(dummy_batch_size, 3, 299, 299, device=args.device)
-    else:
-        dummy_input = torch.randn(dummy_batch_size, 3, 224, 224, device=args.device)
+    resize = classifier.hparams.resize
+    dummy_input = torch.randn(dummy_batch_size, 3, resize, resize, device=args.device)
     
     if args.half: dummy_input = dummy_input.half()
     
@@ -81,13 +80,15 @@ def do_run(args):
             img_paths = [img for img in img_paths if img.endswith(IMG_EXTENSIONS)]
     elif args.SRC.endswith(IMG_EXTENSIONS):  # single img # TODO TEST: single img run
         img_paths.append(args.SRC)
-    image_dataset = ImageDataset(img_paths, resize=299, input_src=args.SRC)
+    # the input size is that of the exported model
+    ort_session = ort.InferenceSession(args.MODEL)
+    resize = ort_session.get_inputs()[0].shape[-1]
+    image_dataset = ImageDataset(img_paths, resize=resize, input_src=args.SRC)
     input_images = [path for _,path in image_dataset]
     input_array = np.asarray([img.numpy() for img,_ in image_dataset])
     #print(image_dataset)
 
     # do inference
-    ort_session = ort.InferenceSession(args.MODEL)
     outputs = ort_session.run(None, {'input':input_array})
     out = np.asarray(outputs[0])
     out = softmax(out,axis=1)
@@ -116,12 +117,12 @@ if __name__ == '__main__':
     run = subparsers.add_parser('RUN', help='Run an onnx model')
 
     # EXPORT from .ptl
-    export.add_argument('MODEL', help='Model .ptl file to convert')
+    export.add_argument('MODEL', help='Model .ptl or .slim.json file to convert')
     export.add_argument('--half', action='store_true', help='Exports model using 16bit floating point precision')
     export.add_argument('--device', default='cpu', choices=('cpu','cuda'), help='Device to load model and tensors to. Default is "cpu"')
     export.add_argument('--opset', default=12, type=int, help='Opset Version for onnx. Default is 12.')
     export.add_argument('--batchsize', default=0, type=int, help='Set a fixed batch input/output batch size for the model. Default is None, ie dynamic batch size')
-    export.add_argument('--output', default=None, help='Same as model file but with ".ptl" replaced with ".onnx"')
+    export.add_argument('--output', default=None, help='Same as model file but with ".ptl" or ".slim.json" replaced with ".onnx"')
 
     # RUN onnx
     run.add_argument('MODEL', help='onnx model file')
@@ -56,7 +56,7 @@ def main(parser):
     args = parser.parse_args()
     if args.cmd_mode is None:
         parser.error('Positional Argument "TRAIN" or "RUN" must be specified.')
-    nn.argparse_nn_runtimeparams(args)
+    nn.argparse_nn_runtimeparams(args, parser)
 
     # if any slurm params are set by user, overwrite the default sbatch dict template value
     for key in SBATCH_DICT:
@@ -0,0 +1,175 @@
+"""A local HTTP server for on-demand classification of bins and images"""
+import argparse
+import base64
+import datetime as dt
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import torch
+from torch.nn.functional import softmax
+from torchvision import transforms
+from torchvision.models.inception import InceptionOutputs
+from PIL import Image
+
+import ifcb
+from neuston_models import load_model
+from neuston_data import IfcbBinDataset, parse_imgnorm
+from neuston_callbacks import run_results_json
+
+
+class DynamicBatcher(threading.Thread):
+    """
+    Coalesces images submitted by concurrent requests into shared batches.
+    A batch is run once it holds batch_size images, or max_latency seconds after its first image was submitted.
+    Example usage:     batcher = DynamicBatcher(classifier, 'cpu', batch_size=64, max_latency=0.05); batcher.start()
+                       scores = [future.result() for future in batcher.submit(tensors)]
+    """
+    def __init__(self, classifier, device, batch_size, max_latency):
+        super().__init__(daemon=True)
+        self.classifier = classifier
+        self.device = device
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()  # (tensor, future)
+        self.batches = 0
+        self.images = 0
+
+    def submit(self, tensors):
+        futures = []
+        for tensor in tensors:
+            future = Future()
+            self.queue.put((tensor, future))
+            futures.append(future)
+        return futures
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time()+self.max_latency
+            while len(items) < self.batch_size:
+                timeout = deadline-time.time()
+                if timeout <= 0: break
+                try: items.append(self.queue.get(timeout=timeout))
+                except queue.Empty: break
+
+            try:
+                batch = torch.stack([tensor for tensor,_ in items]).to(self.device)
+                with torch.no_grad():
+                    outputs = self.classifier(batch)
+                outputs = outputs.logits if isinstance(outputs,InceptionOutputs) else outputs
+                scores = softmax(outputs, dim=1).cpu().numpy()
+                for (_,future),score in zip(items, scores):
+                    future.set_result(score)
+            except Exception as e:
+                for _,future in items:
+                    future.set_exception(e)
+            self.batches += 1
+            self.images += len(items)
+
+
+def make_handler(classifier, batcher, data_dir):
+    hparams = classifier.hparams
+    img_norm = parse_imgnorm(hparams.img_norm) if hparams.img_norm else None
+    image_tforms = [transforms.Resize([hparams.resize, hparams.resize]), transforms.ToTensor()]
+    if img_norm: image_tforms.append(transforms.Normalize(*img_norm))
+    image_tforms = transforms.Compose(image_tforms)
+    dd = ifcb.DataDirectory(data_dir) if data_dir else None
+
+    def results_json(input_images, tensors, bin_id=None, roi_numbers=None):
+        scores = [future.result() for future in batcher.submit(tensors)]
+        output_scores = np.asarray(scores, dtype='f4').reshape(len(scores), len(hparams.classes))
+        results = dict(version='v3',
+                       model_id=hparams.model_id,
+                       timestamp=dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds'),
+                       class_labels=hparams.classes,
+                       input_images=input_images,
+                       output_classes=np.argmax(output_scores, axis=1),
+                       output_scores=output_scores)
+        if bin_id:
+            results['bin_id'] = bin_id
+            results['roi_numbers'] = roi_numbers
+        return run_results_json(results)
+
+    class NeustonRequestHandler(BaseHTTPRequestHandler):
+        """
+        GET  /health           model_id, classes, and batching stats
+        POST /classify/bin     {"bin_id": BIN_ID}, a bin of --data-dir
+        POST /classify/images  {"images": [{"name": NAME, "data": BASE64_IMAGE_BYTES}, ...]}
+        Classification responses have the same schema as RUN's .json OUTFILEs
+        """
+        def send_json(self, obj, status=200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(dict(error='not found: {}'.format(self.path)), 404)
+            self.send_json(dict(model_id=hparams.model_id, classes=hparams.classes,
+                                batches=batcher.batches, images=batcher.images))
+
+        def do_POST(self):
+            try:
+                request = self.read_json()
+                if self.path == '/classify/bin':
+                    if dd is None: return self.send_json(dict(error='server was started without --data-dir'), 400)
+                    try: bin_fileset = dd[request['bin_id']]
+                    except KeyError: return self.send_json(dict(error='bin not found: {}'.format(request.get('bin_id'))), 404)
+                    bin_dataset = IfcbBinDataset(bin_fileset, hparams.resize, hparams.img_norm)
+                    tensors = [img for img,_ in bin_dataset]
+                    response = results_json(bin_dataset.roi_numbers, tensors, bin_fileset.lid, bin_dataset.roi_numbers)
+                elif self.path == '/classify/images':
+                    images = request['images']
+                    tensors = [image_tforms(Image.open(io.BytesIO(base64.b64decode(image['data']))).convert('RGB')) for image in images]
+                    response = results_json([image['name'] for image in images], tensors)
+                else:
+                    return self.send_json(dict(error='not found: {}'.format(self.path)), 404)
+            except Exception as e:
+                return self.send_json(dict(error='{}: {}'.format(type(e).__name__, e)), 400)
+            self.send_json(response)
+
+    return NeustonRequestHandler
+
+
+def serve(args):
+    classifier = load_model(args.MODEL)
+    classifier.eval()
+    classifier.to(args.device)
+    classifier.freeze()
+
+    batcher = DynamicBatcher(classifier, args.device, args.batch_size, args.max_latency/1000)
+    batcher.start()
+    handler = make_handler(classifier, batcher, args.data_dir)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print('Serving {} on http://{}:{}/ Ctrl-C to stop'.format(classifier.hparams.model_id, args.host, args.port))
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a model over local HTTP. Concurrent requests are batched together')
+    parser.add_argument('MODEL', help='Model .ptl or .slim.json file to serve')
+    parser.add_argument('--data-dir', metavar='DIR', help='IFCB data directory from which bins are classified by bin_id')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default is "127.0.0.1", ie localhost only')
+    parser.add_argument('--port', default=8099, type=int, help='Default is 8099')
+    parser.add_argument('--device', default='cpu', choices=('cpu','cuda'), help='Device to load model and tensors to. Default is "cpu"')
+    parser.add_argument('--batch-size', metavar='B', default=108, type=int, help='Maximum number of images per batch. Default is 108')
+    parser.add_argument('--max-latency', metavar='MS', default=50, type=float,
+                        help='Maximum time an image waits for other requests to fill its batch. Default is 50ms')
+
+    args = parser.parse_args()
+    serve(args)
@@ -3,10 +3,22 @@
 import argparse
 import os
 import csv
+import glob
+import time
+import random
+import tarfile
+from functools import partial
+from multiprocessing import Pool
 
 import numpy as np
+import pandas as pd
+import h5py as h5
+import torch
+from sklearn import metrics
 
-from neuston_data import NeustonDataset
+import ifcb
+from neuston_data import NeustonDataset, ShardedDataset, parse_imgnorm
+from neuston_models import load_model, save_slim, get_namebrand_model, get_model_resize, model_stats, format_model_stats
 from torch.utils.data import DataLoader
 from torchvision import transforms
 
@@ -121,6 +133,188 @@ def make_class_config(args):
     write_csv(args.outfile,[header]+rows)
 
 
+def pack_dataset(args):
+    """packs the images of a dataset into sequential tar shards, see ShardedDataset"""
+    if not args.class_config:
+        nd = NeustonDataset(src=args.SRC, dedup=args.dedup)
+    else:
+        nd = NeustonDataset.from_csv(src=args.SRC, csv_file=args.class_config[0], column_to_run=args.class_config[1], dedup=args.dedup)
+    samples = [(img, nd.classes[trg]) for img,trg in zip(nd.images, nd.targets)]
+    random.Random(args.seed).shuffle(samples)  # every shard holds a mix of classes
+
+    os.makedirs(args.OUTDIR, exist_ok=True)
+    shard_bytes = args.shard_size*2**20
+    rows, tar, shard_num = [], None, -1
+    for i,(img,label) in enumerate(samples):
+        if tar is None or tar.offset >= shard_bytes:
+            if tar: tar.close()
+            shard_num += 1
+            shard = ShardedDataset.SHARD_PATTERN.format(shard_num)
+            tar = tarfile.open(os.path.join(args.OUTDIR, shard), 'w')
+        member = '{:08d}{}'.format(i, os.path.splitext(img)[1])
+        tar.add(img, arcname=member)
+        rows.append((img, label, shard, member))
+        if i%10000==0: print('{} of {} images packed'.format(i, len(samples)), flush=True)
+    if tar: tar.close()
+
+    index_file = os.path.join(args.OUTDIR, ShardedDataset.INDEX)
+    pd.DataFrame(rows, columns=['image','label','shard','member']).to_csv(index_file, index=False)
+    print('{} images of {} classes packed into {} shards'.format(len(rows), len(nd.classes), shard_num+1))
+    print('SAVED:', index_file)
+
+
+def read_thresholds(thresholds_csv):
+    """rows of "class_label,threshold". Non-numeric rows (eg a header) are ignored"""
+    thresholds = {}
+    with open(thresholds_csv) as f:
+        for row in csv.reader(f):
+            if len(row) < 2: continue
+            try: thresholds[row[0].strip()] = float(row[1])
+            except ValueError: continue
+    return thresholds
+
+
+def _count_result_file(h5file, thresholds=None):
+    # only output_classes/output_scores and metadata are read, never roi_numbers or input_images
+    with h5.File(h5file, 'r') as f:
+        meta = f['metadata'].attrs
+        class_labels = list(f['class_labels'].asstr()[:])
+        if thresholds:
+            output_scores = f['output_scores'][:].astype('f4')
+            output_classes = np.argmax(output_scores, axis=1)
+            class_thresholds = np.array([thresholds.get(c, 0) for c in class_labels])
+            unclassified = np.max(output_scores, axis=1) < class_thresholds[output_classes]
+        else:
+            output_classes = f['output_classes'][:].astype(int)  # stored as float16
+            unclassified = np.zeros(len(output_classes), dtype=bool)
+        row = dict(bin_id=meta['bin_id'] if 'bin_id' in meta else os.path.basename(h5file),
+                   model_id=meta['model_id'], timestamp=meta['timestamp'],
+                   result_file=h5file, roi_count=len(output_classes))
+
+    counts = np.bincount(output_classes[~unclassified], minlength=len(class_labels))
+    row.update(zip(class_labels, counts.tolist()))
+    if thresholds: row['unclassified'] = int(unclassified.sum())
+    try: row['sample_time'] = ifcb.Pid(row['bin_id']).timestamp.isoformat()
+    except Exception: row['sample_time'] = None
+    return row
+
+
+SUMMARY_META_COLUMNS = ['bin_id', 'sample_time', 'model_id', 'timestamp', 'result_file', 'roi_count']
+
+
+def _write_summary(df, outfile):
+    # .h5 summaries are columnar, one dataset per column. Column order is kept in the "columns" attribute
+    if not outfile.endswith('.h5'):
+        return df.to_csv(outfile, index=False)
+    with h5.File(outfile, 'w') as f:
+        f.attrs['columns'] = np.string_(list(df.columns))
+        for col in df.columns:
+            if col == 'roi_count' or col not in SUMMARY_META_COLUMNS:
+                f.create_dataset(col, data=df[col].to_numpy(dtype='u4'), compression='gzip')
+            else:
+                f.create_dataset(col, data=np.string_(df[col].fillna('').astype(str).tolist()), compression='gzip', dtype=h5.string_dtype())
+
+
+def _read_summary(outfile):
+    if not outfile.endswith('.h5'):
+        return pd.read_csv(outfile)
+    with h5.File(outfile, 'r') as f:
+        columns = [col.decode() for col in f.attrs['columns']]
+        df = pd.DataFrame({col: f[col].asstr()[:] if f[col].dtype.kind=='O' else f[col][:] for col in columns}, columns=columns)
+    return df.replace({col: {'': None} for col in SUMMARY_META_COLUMNS if col in df and df[col].dtype==object})
+
+
+def summarize_results(args):
+    outfile = args.outfile or os.path.join(args.SRC, 'class_counts.h5')
+    scan_start = time.time()
+
+    # incremental mode, only files newer than the last summary are (re)counted
+    previous = None
+    files = glob.glob(os.path.join(args.SRC, '**', args.pattern), recursive=True)
+    files = [f for f in files if os.path.abspath(f) != os.path.abspath(outfile)]
+    if os.path.isfile(outfile) and not args.clobber:
+        previous = _read_summary(outfile)
+        last_summary = os.path.getmtime(outfile)
+        files = [f for f in files if os.path.getmtime(f) > last_summary]
+    print('{} result files to summarize'.format(len(files)))
+
+    thresholds = read_thresholds(args.thresholds) if args.thresholds else None
+    counter = partial(_count_result_file, thresholds=thresholds)
+    rows = []
+    with Pool(args.procs) as pool:
+        for i, row in enumerate(pool.imap_unordered(counter, files, chunksize=64), 1):
+            rows.append(row)
+            if i%1000==0: print('{} of {}'.format(i, len(files)), flush=True)
+
+    df = pd.DataFrame(rows)
+    if previous is not None:
+        # recounted files replace their own rows only, other models' rows for the same bins are kept
+        previous = previous[~previous['result_file'].isin(df['result_file'])] if len(df) else previous
+        df = pd.concat([previous, df], ignore_index=True)
+    if len(df)==0:
+        print('Nothing to summarize')
+        return
+
+    # columnar table: bin x class counts
+    class_cols = sorted(c for c in df.columns if c not in SUMMARY_META_COLUMNS)
+    df[class_cols] = df[class_cols].fillna(0).astype(int)
+    df = df[SUMMARY_META_COLUMNS+class_cols].sort_values('bin_id')
+    _write_summary(df, outfile)
+    # files written during this scan are picked up by the next one
+    os.utime(outfile, (scan_start, scan_start))
+    print('SUMMARY:', outfile)
+
+    if args.daily:
+        daily = df.dropna(subset=['sample_time']).copy()
+        daily['date'] = daily['sample_time'].str.slice(0, 10)  # YYYY-MM-DD
+        daily_groups = daily.groupby('date')
+        daily = daily_groups[['roi_count']+class_cols].sum()
+        daily.insert(0, 'bin_count', daily_groups.size())
+        daily.to_csv(args.daily)
+        print('DAILY SUMMARY:', args.daily)
+
+
+def bench_resize(args):
+    """F1 scores and throughput of models trained at different --resize, on the same labeled held-out images"""
+    rows = []
+    for model_file in args.MODEL:
+        classifier = load_model(model_file)
+        classifier.eval()
+        classifier.to(args.device)
+        classifier.freeze()
+        hparams = classifier.hparams
+        tforms = [transforms.Resize([hparams.resize, hparams.resize]), transforms.ToTensor()]
+        if hparams.img_norm: tforms.append(transforms.Normalize(*parse_imgnorm(hparams.img_norm)))
+
+        # only images of classes the model knows are scored
+        nd = NeustonDataset(src=args.SRC, transforms=transforms.Compose(tforms))
+        nd = nd.subset({label: images for label, images in nd.images_perclass.items() if label in hparams.classes})
+        model_targets = np.array([hparams.classes.index(label) for label in nd.classes])
+        dataloader = DataLoader(nd, batch_size=args.batch_size, shuffle=False, num_workers=args.loaders)
+
+        input_classes, output_classes = [], []
+        start = time.time()
+        with torch.no_grad():
+            for inputs, targets, _ in dataloader:
+                outputs = classifier(inputs.to(args.device))
+                output_classes.append(torch.argmax(outputs, dim=1).cpu().numpy())
+                input_classes.append(model_targets[targets.numpy()])
+        elapsed = time.time()-start
+        input_classes, output_classes = np.concatenate(input_classes), np.concatenate(output_classes)
+
+        rows.append(dict(model_id=hparams.model_id, MODEL=hparams.MODEL, resize=hparams.resize, images=len(nd),
+                         f1_macro=metrics.f1_score(input_classes, output_classes, average='macro', zero_division=0),
+                         f1_weighted=metrics.f1_score(input_classes, output_classes, average='weighted', zero_division=0),
+                         rois_per_second=len(nd)/elapsed))
+        print('{model_id} ({MODEL} @ {resize}): f1_macro={f1_macro:.3f} f1_weighted={f1_weighted:.3f} {rois_per_second:.1f} ROIs/s'.format(**rows[-1]))
+
+    df = pd.DataFrame(rows).sort_values('resize')
+    print(df.to_string(index=False))
+    if args.outfile:
+        df.to_csv(args.outfile, index=False)
+        print('SAVED:', args.outfile)
+
+
 def main(args):
     if args.cmd=='MAKE_DATASET_CONFIG':
         make_dataset_config(args)
@@ -130,6 +324,22 @@ def main(args):
         print('Calculating Image Normalization MEAN and STD...')
         mean,std = calc_img_norm(args)
         print('MEAN={}, STD={}'.format(mean,std))
+    elif args.cmd=='PACK':
+        pack_dataset(args)
+    elif args.cmd=='SUMMARIZE_RESULTS':
+        summarize_results(args)
+    elif args.cmd=='EXPORT_SLIM':
+        output = args.output or os.path.splitext(args.MODEL)[0]+'.slim.json'
+        for output_path in save_slim(load_model(args.MODEL), output):
+            print('EXPORTED:', output_path)
+    elif args.cmd=='BENCH_RESIZE':
+        bench_resize(args)
+    elif args.cmd=='MODEL_STATS':
+        rows = []
+        for model_name in args.MODEL:
+            resize = args.resize or get_model_resize(model_name)
+            rows.append((model_name, resize, model_stats(get_namebrand_model(model_name, args.classes), resize, batch_size=args.batch_size)))
+        print(format_model_stats(rows))
 
 
 if __name__ == '__main__':
@@ -153,13 +363,54 @@ if __name__ == '__main__':
     # IMAGE NORMALIZATION
     imgnorm = subparsers.add_parser('CALC_IMG_NORM', help='Calculate the MEAN and STD of dataset for image normalizing')
     imgnorm.add_argument('SRC')
-    imgnorm.add_argument('--resize', metavar='N', default=299, type=int, choices=[224,299], help='Default is 299 (for inception_v3)')
+    imgnorm.add_argument('--resize', metavar='N', default=299, type=int, help='Use the TRAIN --resize of the model to be trained. Default is 299 (for inception_v3)')
     imgnorm.add_argument('--class-config', metavar=('CSV', 'COL'), nargs=2, help='Skip and combine classes as defined by column COL of a special CSV configuration file')
     imgnorm.add_argument('--class-min', metavar='MIN', default=2, type=int, help='Exclude classes with fewer than MIN instances. Default is 2')
     imgnorm.add_argument('--class-max', metavar='MAX', default=None, type=int, help='Limit classes to a MAX number of instances. '
                            'If multiple datasets are specified with a dataset-configuration csv, classes from lower-priority datasets are truncated first.')
     imgnorm.add_argument('--batch-size', metavar='B', default=108, help='Number of images per minibatch')
 
+    # SHARDED DATASET
+    pack = subparsers.add_parser('PACK', help='Pack a dataset into sequential tar shards, for streaming by TRAIN with fewer file opens')
+    pack.add_argument('SRC', help='Directory with class-label subfolders and images, or a dataset-configuration csv')
+    pack.add_argument('OUTDIR', help='Output directory for shards and their shards.csv index. Use as TRAIN SRC')
+    pack.add_argument('--class-config', metavar=('CSV', 'COL'), nargs=2, help='Skip and combine classes as defined by column COL of a special CSV configuration file')
+    pack.add_argument('--shard-size', metavar='MB', default=256, type=float, help='Approximate size of each shard. Default is 256MB')
+    pack.add_argument('--seed', default=0, type=int, help='Seed for the order in which images are packed')
+    pack.add_argument('--dedup', default=False, action='store_true', help='For SRC dataset-configuration csvs, drop images duplicated across datasets, see TRAIN --dedup')
+
+    # RUN RESULTS SUMMARY
+    summary = subparsers.add_parser('SUMMARIZE_RESULTS', help='Tabulate per-bin class counts from a RUN output directory of .h5 result files')
+    summary.add_argument('SRC', help='RUN output directory. Searched recursively')
+    summary.add_argument('-o', '--outfile', help='Summary .h5 or .csv file. An .h5 summary is columnar, one dataset per column (bin_id, ..., one per class), '
+                                                 'so single classes can be read without reading the whole table. Default is SRC/class_counts.h5')
+    summary.add_argument('--pattern', default='*_class.h5', help='Result file glob pattern. Default is "*_class.h5"')
+    summary.add_argument('--thresholds', metavar='CSV', help='csv of "class_label,threshold" rows. ROIs whose winning score is below their class threshold are counted as "unclassified"')
+    summary.add_argument('--daily', metavar='CSV', help='Additionally write a per-day summary to this csv file')
+    summary.add_argument('--procs', metavar='N', default=os.cpu_count(), type=int, help='Number of worker processes. Default is all cpus')
+    summary.add_argument('--clobber', action='store_true', help='If set, all result files are recounted. By default only files newer than OUTFILE are counted')
+
+    # SLIM INFERENCE MODEL
+    slim = subparsers.add_parser('EXPORT_SLIM', help='Export a .ptl model to an inference-only .slim.json header and memory-mappable .slim.weights file')
+    slim.add_argument('MODEL', help='Model .ptl file to convert')
+    slim.add_argument('-o', '--output', help='Output .slim.json file. Default is MODEL with ".ptl" replaced with ".slim.json"')
+
+    # MODEL COMPARISON
+    stats = subparsers.add_parser('MODEL_STATS', help='Tabulate parameters, GFLOPs and CPU latency of TRAIN base models')
+    stats.add_argument('MODEL', nargs='+', help='Base model names, eg "inception_v3 resnet50 mobilenet_v3_large efficientnet_b0 regnet_y_800mf convnext_tiny"')
+    stats.add_argument('--resize', metavar='N', type=int, help='Input image size. Default is each MODEL\'s default size')
+    stats.add_argument('--classes', metavar='N', default=50, type=int, help='Number of classes of the classifying head. Default is 50')
+    stats.add_argument('--batch-size', metavar='B', default=8, type=int, help='Number of images per timed batch. Default is 8')
+
+    # RESOLUTION BENCHMARK
+    bench = subparsers.add_parser('BENCH_RESIZE', help='Compare F1 and ROIs/s of models trained at different TRAIN --resize sizes')
+    bench.add_argument('SRC', help='Labeled held-out images: a directory with class-label subfolders, or a dataset-configuration csv')
+    bench.add_argument('MODEL', nargs='+', help='Model .ptl or .slim.json files, eg the same MODEL and SRC trained at several --resize sizes')
+    bench.add_argument('--device', default='cpu', choices=('cpu','cuda'), help='Device to benchmark on. Default is "cpu"')
+    bench.add_argument('--batch-size', metavar='B', default=108, type=int, help='Number of images per batch. Default is 108')
+    bench.add_argument('--loaders', metavar='N', default=4, type=int, help='Number of data-loading workers. Default is 4')
+    bench.add_argument('-o', '--outfile', metavar='CSV', help='Additionally write the comparison to this csv file')
+
     # run util command
     args = parser.parse_args()
     main(args)
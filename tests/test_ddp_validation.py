@@ -0,0 +1,119 @@
+"""Checks that distributed (--ddp-cpu) validation gathers the same results as a single process.
+Two local gloo processes validate a small dataset whose length does not divide evenly,
+so DistributedSampler pads one process with a duplicate that collate_validation_steps must drop.
+Run with: python -m pytest tests/   or   python tests/test_ddp_validation.py
+"""
+
+import os
+import socket
+import sys
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.functional import cross_entropy, softmax
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+from sklearn import metrics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from neuston_models import NeustonModel
+
+NUM_IMAGES = 7  # not a multiple of the world size, so one image is padded
+NUM_CLASSES = 3
+WORLD_SIZE = 2
+
+
+class ToyValidationDataset(Dataset):
+    def __init__(self):
+        generator = torch.Generator().manual_seed(0)
+        self.inputs = torch.randn(NUM_IMAGES, 4, generator=generator)
+        self.targets = torch.randint(NUM_CLASSES, (NUM_IMAGES,), generator=generator)
+        self.images = ['img{:02d}.png'.format(idx) for idx in range(NUM_IMAGES)]
+
+    def __getitem__(self, index):
+        return self.inputs[index], self.targets[index], self.images[index]
+
+    def __len__(self):
+        return NUM_IMAGES
+
+
+class ValidationModule:
+    """The parts of a NeustonModel and its trainer that collate_validation_steps uses"""
+    collate_validation_steps = NeustonModel.collate_validation_steps
+
+    class Trainer:
+        def __init__(self, world_size):
+            self.world_size = world_size
+
+    def __init__(self, dataset, world_size):
+        self.dataset = dataset
+        self.trainer = self.Trainer(world_size)
+
+    def val_dataloader(self):
+        return DataLoader(self.dataset)
+
+    def all_gather(self, tensor):
+        gathered = [torch.zeros_like(tensor) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, tensor)
+        return torch.stack(gathered)
+
+
+def validation_steps(dataset, sampler=None):
+    """validation_step outputs of a fixed model, as NeustonModel.validation_step returns them"""
+    torch.manual_seed(0)
+    model = nn.Linear(4, NUM_CLASSES)
+    steps = []
+    with torch.no_grad():
+        for input_data, input_classes, input_srcs in DataLoader(dataset, batch_size=2, sampler=sampler):
+            outputs = model(input_data)
+            steps.append(dict(val_batch_loss=cross_entropy(outputs, input_classes),
+                              val_outputs=softmax(outputs, dim=1),
+                              val_input_classes=input_classes,
+                              val_input_srcs=list(input_srcs)))
+    return steps
+
+
+def _ddp_worker(rank, world_size, port, outfile):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        dataset = ToyValidationDataset()
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=False)  # as lightning shards validation
+        _, outputs, input_classes, input_srcs = ValidationModule(dataset, world_size).collate_validation_steps(validation_steps(dataset, sampler))
+        torch.save(dict(outputs=outputs, input_classes=input_classes, input_srcs=input_srcs), '{}.{}'.format(outfile, rank))
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_ddp_validation_matches_single_process(tmp_path):
+    dataset = ToyValidationDataset()
+    _, outputs, input_classes, input_srcs = ValidationModule(dataset, 1).collate_validation_steps(validation_steps(dataset))
+
+    outfile = str(tmp_path/'ddp_validation.pt')
+    mp.spawn(_ddp_worker, args=(WORLD_SIZE, _free_port(), outfile), nprocs=WORLD_SIZE)
+
+    for rank in range(WORLD_SIZE):  # every rank sees the same, complete results
+        ddp = torch.load('{}.{}'.format(outfile, rank))
+        assert ddp['input_srcs'] == input_srcs, 'padded duplicates must be dropped, and images kept in dataset order'
+        assert torch.equal(ddp['input_classes'], input_classes)
+        np.testing.assert_allclose(ddp['outputs'].numpy(), outputs.numpy(), rtol=1e-6)
+        for average in ['macro', 'weighted']:
+            f1 = lambda outs, classes: metrics.f1_score(classes.numpy(), outs.argmax(dim=1).numpy(), average=average, zero_division=0)
+            assert f1(ddp['outputs'], ddp['input_classes']) == f1(outputs, input_classes)
+
+
+if __name__ == '__main__':
+    import tempfile, pathlib
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_ddp_validation_matches_single_process(pathlib.Path(tmpdir))
+    print('OK: {}-process gloo validation matches a single process'.format(WORLD_SIZE))
@@ -0,0 +1,92 @@
+"""Checks that neuston_server coalesces concurrent requests into shared batches, and answers with RUN's .json schema.
+The server is started on localhost with a tiny toy classifier, on a free port.
+Run with: python -m pytest tests/   or   python tests/test_server.py
+"""
+
+import base64
+import io
+import json
+import os
+import sys
+import threading
+import urllib.request
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from neuston_server import DynamicBatcher, make_handler
+from neuston_callbacks import run_results_json
+
+NUM_REQUESTS = 6
+CLASSES = ['diatom', 'detritus', 'ciliate']
+RESIZE = 8
+
+
+class ToyClassifier(nn.Module):
+    """The parts of a NeustonModel that the server uses"""
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.linear = nn.Linear(3*RESIZE*RESIZE, len(CLASSES))
+        self.hparams = Namespace(model_id='toy', classes=CLASSES, resize=RESIZE, img_norm=None)
+
+    def forward(self, x):
+        return self.linear(x.flatten(start_dim=1))
+
+
+def toy_image(seed):
+    pixels = np.random.RandomState(seed).randint(0, 256, (RESIZE, RESIZE, 3), dtype='u1')
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='png')
+    return dict(name='img{:02d}.png'.format(seed), data=base64.b64encode(buffer.getvalue()).decode())
+
+
+def request(url, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=30) as response:
+        return response.status, json.load(response)
+
+
+def test_concurrent_requests_share_a_batch():
+    classifier = ToyClassifier().eval()
+    # a batch runs once it holds every request's image, well before max_latency
+    batcher = DynamicBatcher(classifier, 'cpu', batch_size=NUM_REQUESTS, max_latency=30)
+    batcher.start()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(classifier, batcher, data_dir=None))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        images = [toy_image(seed) for seed in range(NUM_REQUESTS)]
+        with ThreadPoolExecutor(NUM_REQUESTS) as pool:
+            responses = list(pool.map(lambda image: request(url+'/classify/images', dict(images=[image])), images))
+
+        status, health = request(url+'/health')
+        assert status == 200
+        assert health == dict(model_id='toy', classes=CLASSES, batches=1, images=NUM_REQUESTS), 'concurrent requests must be coalesced into one batch'
+
+        schema = run_results_json(dict(version='v3', model_id='toy', timestamp='', class_labels=CLASSES, input_images=[],
+                                       output_classes=np.zeros(0), output_scores=np.zeros((0, len(CLASSES)))))
+        for image, (status, results) in zip(images, responses):
+            assert status == 200
+            assert set(results) == set(schema)
+            assert results['version'] == 'v3' and results['model_id'] == 'toy' and results['class_labels'] == CLASSES
+            assert results['input_images'] == [image['name']]
+            with torch.no_grad():
+                tensor = torch.from_numpy(np.asarray(Image.open(io.BytesIO(base64.b64decode(image['data']))), dtype='f4')/255)
+                expected = torch.softmax(classifier(tensor.permute(2, 0, 1)[None]), dim=1).numpy()
+            np.testing.assert_allclose(results['output_scores'], expected, rtol=1e-5, atol=1e-6)
+            assert results['output_classes'] == expected.argmax(axis=1).tolist()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_concurrent_requests_share_a_batch()
+    print('OK: {} concurrent requests were classified in one batch'.format(NUM_REQUESTS))